@@ -15,15 +15,21 @@ if sys.version_info[0] < 3:
     raise RuntimeError("Python 3 or above is required.")
 
 import argparse
+import bisect
 import fnmatch
+import hashlib
 import json
 import logging
 import os
 import re
+import sqlite3
+import urllib.parse
+from collections import deque, namedtuple
+from json.decoder import scanstring
 
-import sh
-
-SCRIPT_VERSION = "1.0.5"
+SCRIPT_VERSION = "1.3.0"
+# Increment when the assessment rules change, to invalidate cached results.
+RULESET_VERSION = "4"
 
 LOGLEVELS = {
     "debug": logging.DEBUG,
@@ -33,6 +39,17 @@ LOGLEVELS = {
     "critical": logging.CRITICAL
 }
 
+class Finding(namedtuple("Finding", ["file", "pointer", "property", "rule", "line"])):
+    """
+    A problem detected in a schema, located by the file (relative to the input directory),
+    the JSON pointer within that file, and the line number.
+    """
+    __slots__ = ()
+
+    def key(self):
+        """The identity of the finding for the baseline, which excludes the line number."""
+        return self[:4]
+
 def main():
     parser = argparse.ArgumentParser(
         description="For the specified repository, discover and assess API schema files.")
@@ -46,6 +63,26 @@ def main():
     parser.add_argument("-e", "--excludes",
         nargs="*",
         help="List of additional sub-directories and files to be excluded. Space-delimited.")
+    parser.add_argument("-r", "--follow-refs",
+        action="store_true",
+        help="Follow $ref into child schemas, assessing each reachable schema once.")
+    parser.add_argument("-j", "--json-output",
+        help="Write the findings as JSON to this file.")
+    parser.add_argument("-b", "--baseline",
+        help="Baseline file of known findings to be suppressed (same format as the JSON output).")
+    parser.add_argument("--write-baseline",
+        help="Write all findings to this baseline file.")
+    parser.add_argument("-c", "--cache",
+        help="Cache file (SQLite) of per-schema results, to skip unchanged schemas on later runs.")
+    parser.add_argument("--rules",
+        nargs="+",
+        choices=sorted(RULES),
+        default=sorted(name for name, rule in RULES.items() if rule.default),
+        help="List of rules to be applied. Space-delimited. (Default: %(default)s)")
+    parser.add_argument("--max-enum-size",
+        type=int,
+        default=100,
+        help="Maximum number of \"enum\" values for the enum-size rule. (Default: %(default)s)")
     parser.add_argument("-l", "--loglevel",
         choices=["debug", "info", "warning", "error", "critical"],
         default="info",
@@ -57,16 +94,10 @@ def main():
     logging.basicConfig(stream=sys.stdout,
         format="%(levelname)s: %(name)s: %(message)s", level=loglevel)
     logger = logging.getLogger("api-schema-lint")
-    logging.getLogger("sh").setLevel(logging.ERROR)
 
     # Display a version string
     logger.info("Using api-schema-lint version: %s", SCRIPT_VERSION)
 
-    # Ensure that commands are available
-    if not sh.which("jq"):
-        logger.critical("'jq' is not available.")
-        return 2
-
     # Process and validate the input parameters
     if args.input.startswith("~"):
         input_dir = os.path.expanduser(args.input)
@@ -111,10 +142,33 @@ def main():
     if exclude_files:
         logger.debug("Excluding files: %s", exclude_files)
 
+    baseline = set()
+    if args.baseline:
+        try:
+            baseline = load_baseline(args.baseline)
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logger.critical("Trouble loading baseline file %s: %s", args.baseline, err)
+            return 2
+        logger.info("Loaded %s findings from baseline file: %s", len(baseline), args.baseline)
+
+    rules = RuleSet(args.rules, args)
+    logger.debug("Applying rules: %s", ", ".join(args.rules))
+
+    cache = None
+    if args.cache:
+        try:
+            cache = SchemaCache(args.cache, rules.key)
+        except sqlite3.Error as err:
+            logger.critical("Trouble opening cache file %s: %s", args.cache, err)
+            return 2
+
     exit_code = 0 # Continue processing to detect various issues, then return the result.
+    findings = []
 
     # Find and process the relevant files
     logger.info("Assessing schema files (https://dev.folio.org/guides/describe-schema/)")
+    resolver = SchemaResolver(input_dir, exclude_dirs, rules.object_pairs_hook)
+    all_schema_files = []
     for directory in args.directories:
         schema_files = []
         api_directory = os.path.join(input_dir, directory)
@@ -125,10 +179,33 @@ def main():
                     if not api_fn in exclude_files:
                         schema_files.append(os.path.join(root, api_fn))
         logger.info("Found %s JSON schema files under directory '%s'", len(schema_files), directory)
-        if schema_files:
-            issues_flag = assess_schema_descriptions(schema_files)
+        if args.follow_refs:
+            all_schema_files.extend(schema_files)
+        elif schema_files:
+            issues_flag = assess_schema_descriptions(schema_files, resolver, rules, findings, cache)
             if issues_flag:
                 exit_code = 1
+    if all_schema_files:
+        # Assess all directories together so that shared children are assessed once.
+        issues_flag = assess_schema_references(all_schema_files, resolver, rules, findings, cache)
+        if issues_flag:
+            exit_code = 1
+    if cache:
+        logger.info("Cache: %s schemas unchanged, %s assessed", cache.hits, cache.misses)
+        cache.close()
+
+    # Suppress the known findings, and report the others
+    if args.write_baseline:
+        write_findings(args.write_baseline, findings)
+        logger.info("Wrote %s findings to baseline file: %s", len(findings), args.write_baseline)
+    reported = [finding for finding in findings if finding.key() not in baseline]
+    if len(reported) < len(findings):
+        logger.info("Suppressed %s findings listed in the baseline.", len(findings) - len(reported))
+    report_findings(reported, input_dir, rules.messages)
+    if args.json_output:
+        write_findings(args.json_output, reported)
+    if reported:
+        exit_code = 1
 
     # Report the outcome
     if exit_code == 1:
@@ -140,96 +217,660 @@ def main():
     logging.shutdown()
     return exit_code
 
-def assess_schema_descriptions(schema_files):
+def assess_schema_descriptions(schema_files, resolver, rules, findings, cache=None):
     """
-    Ensure top-level "description" and for each property.
+    Ensure top-level "description" and for each property, and apply the other rules.
+    Findings are appended to the list, and the processing issues flag is returned.
+    Schemas with results in the cache are not assessed again.
     """
     logger = logging.getLogger("api-schema-lint")
     issues = False
     version_schema_re = re.compile(r"json-schema.org/(.+)schema#?")
-    props_skipped = ["id", "metadata", "resultInfo", "tags", "totalRecords"]
     for schema_fn in sorted(schema_files):
         schema_pn = os.path.relpath(schema_fn)
         logger.debug("Processing file: %s", schema_pn)
-        with open(schema_pn, mode="r", encoding="utf-8") as schema_fh:
+        try:
+            schema_text, digest = read_schema_file(schema_fn)
+        except (OSError, ValueError) as err:
+            logger.error("Trouble loading %s: %s", schema_pn, err)
+            issues = True
+            continue
+        cached = cache.get(digest, "") if cache else None
+        if cached:
+            problems, refs, _ = cached
+        else:
             try:
-                schema_data = json.load(schema_fh)
-            except Exception as err:
+                schema_data = json.loads(schema_text, object_pairs_hook=rules.object_pairs_hook)
+            except ValueError as err:
                 logger.error("Trouble loading %s: %s", schema_pn, err)
                 issues = True
                 continue
-        ''' 20210417: disable until OAS 3.1 FOLIO-2948
+            ''' 20210417: disable until OAS 3.1 FOLIO-2948
+            try:
+                keyword_schema = schema_data['$schema']
+            except KeyError:
+                logger.warning('%s: Missing "$schema" keyword.', schema_pn)
+                # FIXME: Should this be an error? Best practice says yes.
+                #issues = True
+            else:
+                match = re.search(version_schema_re, keyword_schema)
+                if not match:
+                    msg = "%s: Malformed $schema keyword: %s"
+                    logger.error(msg, schema_pn, keyword_schema)
+            '''
+            problems, refs, complete = assess_schema_node(schema_pn, schema_data, rules)
+            problems = locate_problems(schema_text, problems)
+            if cache:
+                cache.put(digest, "", problems, refs, complete)
+        ref_problems = assess_schema_refs(schema_fn, refs, resolver, rules)
+        problems = problems + locate_problems(schema_text, ref_problems)
+        schema_file = schema_file_name(schema_fn, resolver.input_dir)
+        findings.extend(Finding(schema_file, *problem) for problem in problems)
+    return issues
+
+def assess_schema_references(schema_files, resolver, rules, findings, cache=None):
+    """
+    Assess the schema files and every schema reachable from them via "$ref".
+    Each schema is assessed once, memoized by absolute path and JSON pointer,
+    and findings are attributed to the schema that defines them.
+    A schema within one already assessed is not assessed again, unless the rules skipped
+    some of its checks there (see Rule.assesses_all).
+    Schemas with results in the cache are not assessed again.
+    """
+    logger = logging.getLogger("api-schema-lint")
+    issues = False
+    assessed = {}
+    reported = set()
+    pending = deque((os.path.abspath(schema_fn), "") for schema_fn in sorted(schema_files))
+    while pending:
+        schema_fn, pointer = pending.popleft()
+        pointers_done = assessed.setdefault(schema_fn, {})
+        if any(done == pointer or (complete and pointer_contains(done, pointer))
+                for done, complete in pointers_done.items()):
+            continue
+        # Sub-schemas which were already fully assessed via a more specific "$ref".
+        skip = {done for done, complete in pointers_done.items()
+            if complete and pointer_contains(pointer, done)}
+        schema_pn = os.path.relpath(schema_fn)
+        if pointer:
+            schema_pn += "#" + pointer
+        logger.debug("Processing schema: %s", schema_pn)
         try:
-            keyword_schema = schema_data['$schema']
-        except KeyError:
-            logger.warning('%s: Missing "$schema" keyword.', schema_pn)
-            # FIXME: Should this be an error? Best practice says yes.
-            #issues = True
+            schema_text, digest = resolver.read(schema_fn)
+            # The results of a partial assessment (skip) are not cached.
+            cached = cache.get(digest, pointer) if cache and not skip else None
+            if cached:
+                problems, refs, complete = cached
+            else:
+                schema_data = resolver.load(schema_fn)
+        except (OSError, ValueError) as err:
+            pointers_done[pointer] = True
+            logger.error("Trouble loading %s: %s", schema_pn, err)
+            issues = True
+            continue
+        if not cached:
+            try:
+                node = resolve_pointer(schema_data, pointer)
+            except LookupError:
+                pointers_done[pointer] = True
+                logger.error("%s: JSON pointer not found.", schema_pn)
+                issues = True
+                continue
+            problems, refs, complete = assess_schema_node(schema_pn, node, rules, pointer,
+                top_level=not pointer, skip=skip)
+            problems = locate_problems(schema_text, problems)
+            if cache and not skip:
+                cache.put(digest, pointer, problems, refs, complete)
+        pointers_done[pointer] = complete
+        ref_problems = assess_schema_refs(schema_fn, refs, resolver, rules)
+        problems = problems + locate_problems(schema_text, ref_problems)
+        schema_file = schema_file_name(schema_fn, resolver.input_dir)
+        # A sub-schema assessed again after a partial assessment repeats some of its problems.
+        for finding in (Finding(schema_file, *problem) for problem in problems):
+            if finding not in reported:
+                reported.add(finding)
+                findings.append(finding)
+        for _, ref in refs:
+            target = resolver.resolve(schema_fn, ref)
+            if target is None:
+                logger.debug("%s: Not following $ref: %s", schema_pn, ref)
+                continue
+            pending.append(target)
+    logger.info("Assessed %s schemas reachable via $ref", sum(len(p) for p in assessed.values()))
+    return issues
+
+def assess_schema_node(schema_pn, node, rules, pointer="", top_level=True, skip=None):
+    """
+    Apply the rules to a schema, where pointer is the JSON pointer of the node within its file,
+    in a single traversal which calls the visitors of each rule.
+    Returns the list of problems as (pointer, property, rule) tuples,
+    the list of "$ref" values that were encountered as (pointer, ref) pairs,
+    and whether every rule assessed all of the sub-schemas.
+    """
+    logger = logging.getLogger("api-schema-lint")
+    problems = []
+    try:
+        node.keys()
+    except AttributeError:
+        logger.debug('%s: Has no keys.', schema_pn)
+        return problems, [], True
+    for visit in rules.schema_visitors:
+        visit(pointer, node, top_level, problems)
+    if 'properties' not in node:
+        logger.debug('%s: Has no object properties.', schema_pn)
+    refs = traverse_schema(node, rules, problems, pointer, skip)
+    complete = all(rule.assesses_all(node) for rule in rules.rules)
+    return problems, refs, complete
+
+def traverse_schema(node, rules, problems, pointer="", skip=None):
+    """
+    Traverse the schema once, calling the object visitors for each object,
+    and the property visitors for each member of each "properties" object.
+    Does not descend into the JSON pointers listed in skip.
+    Returns the "$ref" values as (pointer, ref) pairs.
+    """
+    object_visitors = rules.object_visitors
+    property_visitors = rules.property_visitors
+    refs = []
+    stack = [(pointer, node)]
+    while stack:
+        pointer, value = stack.pop()
+        if skip and pointer in skip:
+            continue
+        if isinstance(value, dict):
+            for visit in object_visitors:
+                visit(pointer, value, problems)
+            props = value.get('properties')
+            if property_visitors and isinstance(props, dict):
+                for prop, prop_value in props.items():
+                    prop_pointer = pointer + "/properties/" + escape_pointer_token(prop)
+                    for visit in property_visitors:
+                        visit(prop_pointer, prop, prop_value, problems)
+            ref = value.get('$ref')
+            if isinstance(ref, str):
+                refs.append((pointer, ref))
+            children = value.items()
+        elif isinstance(value, list):
+            children = enumerate(value)
         else:
-            match = re.search(version_schema_re, keyword_schema)
-            if not match:
-                msg = "%s: Malformed $schema keyword: %s"
-                logger.error(msg, schema_pn, keyword_schema)
-        '''
-        try:
-            schema_data.keys()
-        except AttributeError:
-            logger.debug('%s: Has no keys.', schema_pn)
             continue
+        for key, child in reversed(list(children)):
+            if isinstance(child, (dict, list)):
+                stack.append((pointer + "/" + escape_pointer_token(str(key)), child))
+    return refs
+
+def assess_schema_refs(schema_fn, refs, resolver, rules):
+    """
+    Call the ref visitors for each "$ref" of a schema.
+    These depend upon other files, so are applied also to cached results.
+    """
+    problems = []
+    for visit in rules.ref_visitors:
+        for pointer, ref in refs:
+            visit(resolver, schema_fn, pointer, ref, problems)
+    return problems
+
+def locate_problems(schema_text, problems):
+    """
+    Append the line number to each problem, using the JSON pointer.
+    The position-tracking scan is done only for schemas which have problems.
+    """
+    if not problems:
+        return problems
+    lines = locate_pointers(schema_text, {problem[0] for problem in problems})
+    return [problem + (lines.get(problem[0]),) for problem in problems]
+
+def report_findings(findings, input_dir, messages):
+    """
+    Log the findings, grouped by schema file.
+    """
+    logger = logging.getLogger("api-schema-lint")
+    grouped = {}
+    for finding in findings:
+        grouped.setdefault(finding.file, []).append(finding)
+    for schema_file, schema_findings in grouped.items():
+        schema_pn = os.path.relpath(os.path.join(input_dir, schema_file))
+        desc_missing = []
+        for finding in schema_findings:
+            location = "%s (line %s)" % (finding.property or finding.pointer or "top-level",
+                finding.line)
+            if finding.rule in ("description-missing", "description-short"):
+                desc_missing.append((finding.line or 0, location))
+            elif finding.rule in ("top-description-missing", "top-description-short"):
+                logger.error("%s: %s", schema_pn, messages[finding.rule])
+            else:
+                logger.error("%s: %s: %s", schema_pn, messages[finding.rule], location)
+        if desc_missing:
+            msg = '%s: Missing "description" for: %s'
+            logger.error(msg, schema_pn, ', '.join(location for _, location in sorted(desc_missing)))
+
+def write_findings(output_fn, findings):
+    """
+    Write the findings as JSON. This is also the format of the baseline file.
+    """
+    output = {
+        "version": SCRIPT_VERSION,
+        "findings": [finding._asdict() for finding in findings]
+    }
+    with open(output_fn, mode="w", encoding="utf-8") as output_fh:
+        json.dump(output, output_fh, indent=2)
+        output_fh.write("\n")
+
+def load_baseline(baseline_fn):
+    """
+    Load the baseline file as a set of finding keys, for hashed lookup.
+    """
+    with open(baseline_fn, mode="r", encoding="utf-8") as baseline_fh:
+        baseline_data = json.load(baseline_fh)
+    return {(finding["file"], finding["pointer"], finding["property"], finding["rule"])
+        for finding in baseline_data["findings"]}
+
+def schema_file_name(schema_fn, input_dir):
+    """
+    Return the portable name of the schema file, relative to the input directory.
+    """
+    return os.path.relpath(schema_fn, input_dir).replace(os.sep, "/")
+
+RULES = {}
+
+def register_rule(rule_class):
+    """
+    Register a rule class (decorator), making it available to the --rules option.
+    """
+    RULES[rule_class.name] = rule_class
+    return rule_class
+
+class Rule:
+    """
+    A schema quality rule, which implements one or more visitors.
+    All visitors are called during the single traversal of each schema:
+      visit_schema(pointer, node, top_level, problems) -- the top of each schema.
+      visit_object(pointer, node, problems) -- each object within the schema.
+      visit_property(pointer, prop, value, problems) -- each member of each "properties".
+      visit_ref(resolver, schema_fn, pointer, ref, problems) -- each "$ref" value.
+    Each visitor appends its problems as (pointer, property, rule) tuples,
+    where the rule is one of the keys of messages.
+    """
+    name = None
+    default = False
+    messages = {}
+    object_pairs_hook = None
+    visit_schema = None
+    visit_object = None
+    visit_property = None
+    visit_ref = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def key(self):
+        """Identify the rule and its options, for the cache."""
+        return self.name
+
+    def assesses_all(self, node):
+        """
+        Determine whether the visitors assess every sub-schema of a schema with this top node,
+        so that a "$ref" to a sub-schema need not be assessed again.
+        """
+        return True
+
+@register_rule
+class DescriptionRule(Rule):
+    """
+    Ensure top-level "description" and for each property.
+    As before, properties are assessed only if the top of the schema has "properties".
+    """
+    name = "description"
+    default = True
+    messages = {
+        "top-description-missing": 'Missing top-level "description".',
+        "top-description-short": 'The top-level "description" is too short.',
+        "description-missing": 'Missing "description"',
+        "description-short": 'The "description" is too short',
+        "property-misplaced": 'Trouble determining "description" for property, perhaps misplaced',
+    }
+    props_skipped = frozenset(["id", "metadata", "resultInfo", "tags", "totalRecords"])
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.assess_properties = False
+
+    def visit_schema(self, pointer, node, top_level, problems):
+        self.assess_properties = 'properties' in node
+        if not top_level:
+            return
         try:
-            desc = schema_data['description']
+            desc = node['description']
         except KeyError:
-            logger.error('%s: Missing top-level "description".', schema_pn)
-            issues = True
+            problems.append((pointer, "", "top-description-missing"))
         else:
             if len(desc) < 3:
-                logger.error('%s: The top-level "description" is too short.', schema_pn)
-                issues = True
+                problems.append((pointer, "", "top-description-short"))
+
+    def assesses_all(self, node):
+        return 'properties' in node
+
+    def visit_property(self, pointer, prop, value, problems):
+        if not self.assess_properties or prop in self.props_skipped:
+            return
         try:
-            properties = schema_data['properties']
+            desc = value['description']
         except KeyError:
-            logger.debug('%s: Has no object properties.', schema_pn)
-            continue
-        # Use jq to gather all properties into easier-to-use form.
-        jq_filter = '[ .. | .properties? | objects ]'
+            problems.append((pointer, prop, "description-missing"))
+        except TypeError:
+            problems.append((pointer, prop, "property-misplaced"))
+        else:
+            if len(desc) < 3:
+                problems.append((pointer, prop, "description-short"))
+
+@register_rule
+class TypeRule(Rule):
+    """
+    Ensure that each property declares its "type", unless it is otherwise defined.
+    """
+    name = "type"
+    messages = {"type-missing": 'Missing "type" for property'}
+    defining_keywords = ("type", "$ref", "allOf", "anyOf", "oneOf", "not", "enum", "const")
+
+    def visit_property(self, pointer, prop, value, problems):
+        if isinstance(value, dict) and not any(kw in value for kw in self.defining_keywords):
+            problems.append((pointer, prop, "type-missing"))
+
+@register_rule
+class AdditionalPropertiesRule(Rule):
+    """
+    Ensure that each object schema with "properties" sets "additionalProperties".
+    """
+    name = "additional-properties"
+    messages = {"additional-properties-unset": '"additionalProperties" is not set'}
+
+    def visit_object(self, pointer, node, problems):
+        if isinstance(node.get('properties'), dict) and 'additionalProperties' not in node:
+            problems.append((pointer, "", "additional-properties-unset"))
+
+@register_rule
+class RefRule(Rule):
+    """
+    Ensure that each local "$ref" can be resolved to a file and JSON pointer.
+    """
+    name = "ref"
+    messages = {"ref-unresolved": 'Unresolved "$ref"'}
+
+    def visit_ref(self, resolver, schema_fn, pointer, ref, problems):
+        target = resolver.locate(schema_fn, ref)
+        if target is None:
+            return
+        target_fn, target_pointer = target
         try:
-            result_jq = sh.jq('--monochrome-output', jq_filter, schema_pn)
-        except sh.ErrorReturnCode_2 as err:
-            logger.error("Trouble doing jq: usage error: %s", err.stderr.decode())
-            issues = True
-        except sh.ErrorReturnCode_3 as err:
-            logger.error("Trouble doing jq: compile error: %s", err.stderr.decode())
-            issues = True
+            resolve_pointer(resolver.load(target_fn), target_pointer)
+        except (OSError, ValueError, LookupError):
+            problems.append((pointer + "/$ref", ref, "ref-unresolved"))
+
+class SchemaObject(dict):
+    """
+    A JSON object which records its duplicated member names.
+    """
+    duplicates = ()
+
+def schema_object_pairs(pairs):
+    """
+    The object_pairs_hook for the JSON decoder, to detect duplicated member names.
+    """
+    node = SchemaObject(pairs)
+    if len(node) < len(pairs):
+        seen = set()
+        duplicates = set()
+        for key, _ in pairs:
+            if key in seen:
+                duplicates.add(key)
+            seen.add(key)
+        node.duplicates = sorted(duplicates)
+    return node
+
+@register_rule
+class DuplicatePropertyRule(Rule):
+    """
+    Ensure that no property is defined more than once in a "properties" object.
+    (The JSON decoder would otherwise silently keep the last definition.)
+    """
+    name = "duplicate-property"
+    messages = {"property-duplicate": "Duplicate property definition"}
+    object_pairs_hook = staticmethod(schema_object_pairs)
+
+    def visit_object(self, pointer, node, problems):
+        props = node.get('properties')
+        for prop in getattr(props, 'duplicates', ()):
+            problems.append((pointer + "/properties/" + escape_pointer_token(prop),
+                prop, "property-duplicate"))
+
+@register_rule
+class EnumSizeRule(Rule):
+    """
+    Ensure that an "enum" does not have more than the maximum number of values.
+    """
+    name = "enum-size"
+    messages = {"enum-oversize": 'Oversize "enum"'}
+
+    def key(self):
+        return "%s=%s" % (self.name, self.options.max_enum_size)
+
+    def visit_object(self, pointer, node, problems):
+        enum = node.get('enum')
+        if isinstance(enum, list) and len(enum) > self.options.max_enum_size:
+            problems.append((pointer + "/enum", "", "enum-oversize"))
+
+class RuleSet:
+    """
+    The enabled rules, with their visitors gathered by kind for the single traversal.
+    """
+    def __init__(self, rule_names, options):
+        self.rules = [RULES[name](options) for name in sorted(set(rule_names))]
+        self.schema_visitors = [rule.visit_schema for rule in self.rules if rule.visit_schema]
+        self.object_visitors = [rule.visit_object for rule in self.rules if rule.visit_object]
+        self.property_visitors = [rule.visit_property for rule in self.rules if rule.visit_property]
+        self.ref_visitors = [rule.visit_ref for rule in self.rules if rule.visit_ref]
+        self.messages = {}
+        self.object_pairs_hook = None
+        for rule in self.rules:
+            self.messages.update(rule.messages)
+            if rule.object_pairs_hook:
+                self.object_pairs_hook = rule.object_pairs_hook
+        self.key = RULESET_VERSION + ":" + ",".join(rule.key() for rule in self.rules)
+
+class SchemaResolver:
+    """
+    Load each schema file once and resolve "$ref" values to (absolute path, JSON pointer).
+    References to remote schemas and into excluded directories are not followed.
+    """
+    def __init__(self, input_dir, exclude_dirs, object_pairs_hook=None):
+        self.input_dir = os.path.abspath(input_dir)
+        self.exclude_dirs = exclude_dirs
+        self.object_pairs_hook = object_pairs_hook
+        self.contents = {}
+        self.documents = {}
+
+    def read(self, schema_fn):
+        """Return the text and content hash of the schema file, reading it only once."""
+        try:
+            return self.contents[schema_fn]
+        except KeyError:
+            pass
+        self.contents[schema_fn] = read_schema_file(schema_fn)
+        return self.contents[schema_fn]
+
+    def load(self, schema_fn):
+        """Return the parsed content of the schema file, parsing it only once."""
+        try:
+            return self.documents[schema_fn]
+        except KeyError:
+            pass
+        schema_data = json.loads(self.read(schema_fn)[0], object_pairs_hook=self.object_pairs_hook)
+        self.documents[schema_fn] = schema_data
+        return schema_data
+
+    def resolve(self, base_fn, ref):
+        """Return the (absolute path, JSON pointer) target of the ref to be followed, or None."""
+        target = self.locate(base_fn, ref)
+        if target is None:
+            return None
+        rel_parts = os.path.relpath(target[0], self.input_dir).split(os.sep)
+        if self.exclude_dirs.intersection(rel_parts[:-1]):
+            return None
+        return target
+
+    def locate(self, base_fn, ref):
+        """Return the (absolute path, JSON pointer) target of a local ref, or None."""
+        ref_path, _, fragment = ref.partition("#")
+        if urllib.parse.urlsplit(ref_path).scheme:
+            return None
+        pointer = urllib.parse.unquote(fragment)
+        if pointer and not pointer.startswith("/"):
+            return None
+        if ref_path:
+            target_fn = os.path.normpath(os.path.join(os.path.dirname(base_fn),
+                urllib.parse.unquote(ref_path)))
         else:
-            try:
-                jq_content = json.loads(result_jq)
-            except Exception as err:
-                logger.error("Trouble loading JSON obtained from jq: %s", err)
-                issues = True
-                continue
+            target_fn = base_fn
+        return target_fn, pointer
+
+class SchemaCache:
+    """
+    Cache of per-schema results (problems and "$ref" values) in a single SQLite file,
+    keyed by the content hash of the schema file, the JSON pointer, and the rule-set version.
+    Entries which were not used by this run are pruned on close, to keep the file compact.
+    """
+    def __init__(self, cache_fn, ruleset):
+        self.ruleset = ruleset
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self.connection = sqlite3.connect(cache_fn)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " digest TEXT NOT NULL, pointer TEXT NOT NULL, ruleset TEXT NOT NULL,"
+            " result TEXT NOT NULL, PRIMARY KEY (digest, pointer, ruleset)) WITHOUT ROWID")
+
+    def get(self, digest, pointer):
+        """Return the cached (problems, refs, complete) for the schema, or None."""
+        row = self.connection.execute(
+            "SELECT result FROM results WHERE digest = ? AND pointer = ? AND ruleset = ?",
+            (digest, pointer, self.ruleset)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.add((digest, pointer))
+        result = json.loads(row[0])
+        return ([tuple(problem) for problem in result["problems"]],
+            [tuple(ref) for ref in result["refs"]], result["complete"])
+
+    def put(self, digest, pointer, problems, refs, complete):
+        """Store the results for the schema."""
+        self.used.add((digest, pointer))
+        result = json.dumps({"problems": problems, "refs": refs, "complete": complete},
+            separators=(",", ":"))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results (digest, pointer, ruleset, result) VALUES (?, ?, ?, ?)",
+            (digest, pointer, self.ruleset, result))
+
+    def close(self):
+        """Prune the entries which were not used, then commit and close."""
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE used (digest TEXT, pointer TEXT, PRIMARY KEY (digest, pointer))")
+            self.connection.executemany("INSERT INTO used VALUES (?, ?)", self.used)
+            self.connection.execute(
+                "DELETE FROM results WHERE ruleset != ? OR NOT EXISTS (SELECT 1 FROM used"
+                " WHERE used.digest = results.digest AND used.pointer = results.pointer)",
+                (self.ruleset,))
+        self.connection.execute("VACUUM")
+        self.connection.close()
+
+def read_schema_file(schema_fn):
+    """
+    Return the text of the schema file and the hash of its content.
+    """
+    with open(schema_fn, mode="rb") as schema_fh:
+        content = schema_fh.read()
+    return content.decode("utf-8"), hashlib.sha256(content).hexdigest()
+
+def locate_pointers(schema_text, pointers):
+    """
+    Return the line number of each JSON pointer within the JSON text.
+    For an object member, that is the line of its key.
+    Only the containers on the path to a wanted pointer are scanned token by token,
+    while other values are skipped using the JSON decoder.
+    """
+    decoder = json.JSONDecoder()
+    whitespace_re = re.compile(r"[ \t\n\r]*")
+    newlines = [match.start() for match in re.finditer("\n", schema_text)]
+    prefixes = {""}
+    for pointer in pointers:
+        while pointer:
+            prefixes.add(pointer)
+            pointer = pointer.rpartition("/")[0]
+    lines = {}
+
+    def skip_whitespace(pos):
+        return whitespace_re.match(schema_text, pos).end()
+
+    def scan(pos, pointer):
+        # Scan the value at pos, and return the position after it.
+        if pointer not in prefixes:
+            return decoder.raw_decode(schema_text, pos)[1]
+        char = schema_text[pos]
+        if char not in "{[":
+            return decoder.raw_decode(schema_text, pos)[1]
+        pos = skip_whitespace(pos + 1)
+        index = 0
+        while schema_text[pos] not in "}]":
+            if char == "{":
+                key_pos = pos
+                key, pos = scanstring(schema_text, pos + 1)
+                pos = skip_whitespace(skip_whitespace(pos) + 1)
+                child = pointer + "/" + escape_pointer_token(key)
             else:
-                # logger.debug("JQ: %s", jq_content)
-                desc_missing = []
-                for props in jq_content:
-                    for prop in props:
-                        if prop in props_skipped:
-                            continue
-                        try:
-                            desc = props[prop]['description']
-                        except KeyError:
-                            desc_missing.append(prop)
-                        except TypeError:
-                            msg = '%s: Trouble determining "description" for property, perhaps misplaced.'
-                            logger.error(msg, schema_pn)
-                            desc_missing.append("misplaced")
-                        else:
-                            if len(desc) < 3:
-                                desc_missing.append(prop)
-                if desc_missing:
-                    msg = '%s: Missing "description" for: %s'
-                    logger.error(msg, schema_pn, ', '.join(sorted(desc_missing)))
-                    issues = True
-    return issues
+                key_pos = pos
+                child = pointer + "/" + str(index)
+                index += 1
+            if child in pointers:
+                lines[child] = bisect.bisect_left(newlines, key_pos) + 1
+            pos = skip_whitespace(scan(pos, child))
+            if schema_text[pos] == ",":
+                pos = skip_whitespace(pos + 1)
+        return pos + 1
+
+    start = skip_whitespace(0)
+    if "" in pointers:
+        lines[""] = bisect.bisect_left(newlines, start) + 1
+    scan(start, "")
+    return lines
+
+def resolve_pointer(data, pointer):
+    """Return the part of data at the JSON pointer (RFC 6901)."""
+    if not pointer:
+        return data
+    for token in pointer[1:].split("/"):
+        token = token.replace("~1", "/").replace("~0", "~")
+        if isinstance(data, list):
+            try:
+                data = data[int(token)]
+            except ValueError as err:
+                raise LookupError(token) from err
+        else:
+            try:
+                data = data[token]
+            except TypeError as err:
+                raise LookupError(token) from err
+    return data
+
+def escape_pointer_token(token):
+    """Escape a JSON pointer reference token."""
+    return token.replace("~", "~0").replace("/", "~1")
+
+def pointer_contains(outer, inner):
+    """Determine whether the inner JSON pointer is equal to or within the outer."""
+    return not outer or inner == outer or inner.startswith(outer + "/")
 
 if __name__ == "__main__":
     sys.exit(main())
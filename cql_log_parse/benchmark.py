@@ -0,0 +1,100 @@
+"""
+Benchmark the parsing of a synthetic Okapi log file, reporting the lines per second and the memory used,
+and failing (exit status 1) when below or above the given limits, to catch performance regressions.
+
+usage: python benchmark.py [--size-mb 1024] [--workers 1] [--noise-ratio 0.9] [--formats cql-query,cqlhelper,unified]
+    [--details] [--memory] [--min-lines-per-second 600000] [--max-memory-mb N] [--keep path_to_log_file]
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cql_log_parse
+import synthetic_log
+
+def count_queries(log_file_path, workers=1, details=False):
+    """
+    Parse the log as a stream, returning the number of entries found.
+    details: Derive the fields of the log lines, as for the sqlite and parquet outputs,
+      else only the time, CQL and SQL, as for the CSV output
+    """
+    return sum(1 for _ in cql_log_parse.iter_queries(log_file_path, workers=workers, details=details))
+
+def measure_memory(log_file_path, details=False):
+    """
+    The peak memory (in bytes) allocated by Python while parsing the log in this process.
+    """
+    tracemalloc.start()
+    try:
+        count_queries(log_file_path, details=details)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing of a synthetic Okapi logfile')
+    parser.add_argument('--size-mb', type=int, default=1024, help="Size of the synthetic log")
+    parser.add_argument('--workers', type=int, default=1,
+            help="The number of processes for parallel parsing (0 for the number of CPUs)")
+    parser.add_argument('--noise-ratio', type=float, default=0.9,
+            help="The fraction of the entries which are noise lines rather than queries")
+    parser.add_argument('--formats', default=','.join(synthetic_log.QUERY_FORMATS),
+            help="The comma separated formats of the queries, of: "
+            f"{', '.join(synthetic_log.QUERY_FORMATS)}")
+    parser.add_argument('--seed', type=int, default=1, help="The seed of the random content")
+    parser.add_argument('--details', action='store_true',
+            help="Derive the fields of the log lines, as for the sqlite and parquet outputs")
+    parser.add_argument('--memory', action='store_true',
+            help="Also parse the log with tracemalloc, to report the peak memory allocated by the parser")
+    parser.add_argument('--min-lines-per-second', type=float, default=600000,
+            help="Fail if the parser is slower than this (0 for no check)")
+    parser.add_argument('--max-memory-mb', type=float, default=None,
+            help="Fail if the parser allocates more than this (implies --memory)")
+    parser.add_argument('--keep', help="Keep the synthetic log at this path")
+    args = parser.parse_args()
+
+    if args.keep:
+        log_file_path = args.keep
+    else:
+        fd, log_file_path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+    peak = None
+    try:
+        with open(log_file_path, 'w') as log_handle:
+            size, lines, _ = synthetic_log.write_synthetic_log(log_handle, args.size_mb * 1024 * 1024,
+                    args.noise_ratio, args.formats.split(','), args.seed)
+        start = time.perf_counter()
+        queries = count_queries(log_file_path, args.workers, args.details)
+        elapsed = time.perf_counter() - start
+        if args.memory or args.max_memory_mb is not None:
+            peak = measure_memory(log_file_path, args.details)
+    finally:
+        if not args.keep:
+            os.remove(log_file_path)
+
+    lines_per_second = lines / elapsed
+    print(f"Parsed {size / 1024 / 1024:.0f} MB, {lines} lines in {elapsed:.2f} s "
+          f"({lines_per_second:,.0f} lines/s, {size / 1024 / 1024 / elapsed:.1f} MB/s), "
+          f"found {queries} queries")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"Maximum resident set size {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    if peak is not None:
+        print(f"Peak memory allocated while parsing {peak / 1024:,.0f} KB")
+
+    failures = []
+    if args.min_lines_per_second and lines_per_second < args.min_lines_per_second:
+        failures.append(f"{lines_per_second:,.0f} lines/s is below {args.min_lines_per_second:,.0f}")
+    if args.max_memory_mb is not None and peak / 1024 / 1024 > args.max_memory_mb:
+        failures.append(f"{peak / 1024 / 1024:.1f} MB is above {args.max_memory_mb} MB")
+    for failure in failures:
+        sys.stderr.write(f"Benchmark failed: {failure}\n")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
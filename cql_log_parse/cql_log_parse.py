@@ -1,120 +1,1127 @@
 import re
 import csv
 import argparse
+import bz2
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import math
+import mmap
+import multiprocessing
+import os
 import sys
-from itertools import groupby
-from operator import itemgetter
+import sqlite3
+import time
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+class LinePattern:
+    """
+    A precompiled regex which is only tried on lines containing its literal marker,
+    anchored at the last occurrence of that marker (as with a leading greedy ".*").
+    The substring search rejects most lines without any regex work.
+    """
+    def __init__(self, marker, pattern):
+        self.marker = marker
+        self.regex = re.compile(re.escape(marker) + pattern)
+
+    def match(self, line):
+        pos = line.rfind(self.marker)
+        if pos < 0:
+            return None
+        return self.regex.match(line, pos)
 
 cql_to_sql_reg_pairs = ( \
-        (r".*CQL query:\s+(.+)", ( r".*SQL generated from CQL:\s+(.*)",) ),
-        (r".*CqlHelper\s+Encoding query\s+(.*)", (r".*SQL generated by CQL query\s+.+:\s+(.*)", r".*SQL generated from CQL:\s+(.*)"))
+        (LinePattern("CQL query:", r"\s+(.+)"), (LinePattern("SQL generated from CQL:", r"\s+(.*)"),) ),
+        (LinePattern("CqlHelper", r"\s+Encoding query\s+(.*)"), (LinePattern("SQL generated by CQL query", r"\s+.+:\s+(.*)"), LinePattern("SQL generated from CQL:", r"\s+(.*)")))
 )
 
 #regex for new unified format
-unified_sql_cql_reg = r".*CQL >>> SQL:\s+(.+)\s>>>\s+(.+)"
-
-def get_time(log_handle, max_lines=3):
-    time_reg = r".*ProxyContext.*\d+\s+(\d+)us\s+.*"
-    count = 1
-    line = log_handle.readline()
-    while line and count <= max_lines:
-        time_match = re.match(time_reg, line)
-        if time_match:
-            return time_match.group(1)
-        line = log_handle.readline()
-    return None
+unified_sql_cql_reg = LinePattern("CQL >>> SQL:", r"\s+(.+)\s>>>\s+(.+)")
+
+#The timing of the request, with the Okapi request id (such as 123456/instance-storage) where present
+time_reg = LinePattern("ProxyContext", r"(?:\s+(?P<request_id>\d+/\S*))?.*\d+\s+(?P<time>\d+)us\s+.*")
+
+#Match the major pieces of a log entry
+log_reg = re.compile(r"(?P<date>\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d,\d+)\s+(?P<level>\S+)\s+(?P<class>\S+)\s+(?P<module>\S+)\s(?P<body>.*)")
+
+#The FolioLoggingContext of the log line, where present
+folio_context_reg = re.compile(r"\[(?P<request_id>[^\]\s]*)\]\s+\[(?P<tenant>[^\]\s]*)\]\s+"
+        r"\[(?P<user_id>[^\]\s]*)\]\s+\[(?P<module_id>[^\]\s]*)\]")
+
+#The tenant of the database schema in the SQL, such as diku_mod_inventory_storage.instance
+sql_tenant_reg = re.compile(r"\b(?P<tenant>[a-z0-9]+)_mod_[a-z0-9_]+\.")
 
-def get_sql(sql_reg_list, log_handle, max_lines=4):
+#An entry found in the log: the time (in microseconds) of the request, the CQL and SQL,
+#and the fields of the CQL log line, which may be None when absent or not derived
+QueryRecord = namedtuple('QueryRecord',
+        ('time', 'cql', 'sql', 'timestamp', 'level', 'log_class', 'module', 'tenant', 'request_id'),
+        defaults=(None,) * 6)
+
+def get_query_record(time_match, cql, sql, line, line_match=None):
     """
-    sql_reg_list: A list of regular expressions to attempt to match a line of log containing SQL
-    log_handle: An open handle to a log file that we're searching
-    max_lines: The maximum number of lines to try searching before bailing
-    """
-    count = 1
-    line = log_handle.readline()
-    while line and count <= max_lines:
-        sql_match = None
-        for sql_reg in sql_reg_list:
-            sql_match = re.match(sql_reg, line)
-            if sql_match:
-                return sql_match.group(1)
-        count = count + 1
-        line = log_handle.readline()
+    The QueryRecord of the CQL log line and the ProxyContext line matching time_reg.
+    The timestamp is in ISO format (2023-06-01 12:00:00.000).
+    The tenant, request id and module are taken from the FolioLoggingContext of the line where present,
+    else from the schema of the SQL, the ProxyContext line and the module of the line.
+    """
+    line_match = line_match or log_reg.match(line)
+    if line_match:
+        date, level, log_class, module = line_match.group('date', 'level', 'class', 'module')
+        timestamp = date.replace(',', '.')
+    else:
+        timestamp = level = log_class = module = None
+    tenant = request_id = None
+    context_match = folio_context_reg.search(line) if "[" in line else None
+    if context_match:
+        tenant = context_match.group('tenant') or None
+        request_id = context_match.group('request_id') or None
+        module = context_match.group('module_id') or module
+    if not tenant and "_mod_" in sql:
+        tenant_match = sql_tenant_reg.search(sql)
+        tenant = tenant_match.group('tenant') if tenant_match else None
+    if not request_id:
+        request_id = time_match.group('request_id')
+    return QueryRecord(time_match.group('time'), cql, sql, timestamp, level, log_class, module,
+            tenant, request_id)
+
+#The number of lines to scan for the time following the SQL
+TIME_SCAN_LINES = 3
+
+#The minimum size of a chunk of the log for parallel parsing
+MIN_CHUNK_SIZE = 16 * 1024 * 1024
+
+#The number of lines to scan for the SQL and time of an entry correlated by request id,
+#as the lines of concurrent requests may be far apart
+REQUEST_SCAN_LINES = 1000
+
+def get_sql(sql_reg_list, line):
+    """
+    The SQL of the line, if it matches one of sql_reg_list, else None.
+    """
+    for sql_reg in sql_reg_list:
+        sql_match = sql_reg.match(line)
+        if sql_match:
+            return sql_match.group(1)
     return None
 
+def get_context_request_id(line):
+    context_match = folio_context_reg.search(line) if "[" in line else None
+    return context_match.group('request_id') or None if context_match else None
+
+class PendingQuery:
+    """
+    An entry whose CQL has been found, waiting for its SQL (matching one of sql_regs)
+    and then its time, until the line number deadline.
+    """
+    __slots__ = ('cql', 'sql', 'sql_regs', 'line', 'line_match', 'request_id', 'deadline', 'emit')
+
+    def __init__(self, cql, sql, sql_regs, line, line_match, deadline, emit):
+        self.cql = cql
+        self.sql = sql
+        self.sql_regs = sql_regs
+        self.line = line
+        self.line_match = line_match
+        self.request_id = get_context_request_id(line)
+        self.deadline = deadline
+        self.emit = emit
+
+def find_pending(pending, request_id, match):
+    """
+    The first (entry, value) of the pending entries for which match(entry) is a value, preferring
+    the entry with the same request id, else one which is not correlated with another request id.
+    """
+    fallback = None
+    for entry in pending:
+        if fallback is not None and entry.request_id != request_id:
+            continue
+        value = match(entry)
+        if value is None:
+            continue
+        if request_id and entry.request_id == request_id:
+            return (entry, value)
+        if fallback is None and (entry.request_id is None or request_id is None):
+            fallback = (entry, value)
+    return fallback
+
+#Literals in CQL: the term following a relation (with any modifiers), and remaining quoted terms
+cql_term_reg = re.compile(r'(?P<relation>(?:==|<>|<=|>=|=|<|>|\b(?:all|any|adj|within)\b)(?:/[\w.]+)*\s*)'
+        r'(?P<term>"(?:[^"\\]|\\.)*"|[^\s()"=<>][^\s()"]*)', re.IGNORECASE)
+cql_quoted_reg = re.compile(r'"(?:[^"\\]|\\.)*"')
+#Repeated clauses such as id==? or id==? or ...
+cql_repeat_reg = re.compile(r'(?P<clause>\b[\w.]+==\?)(?:\s+or\s+(?P=clause))+', re.IGNORECASE)
+
+#Literals in SQL: strings, except JSON field names following -> or ->>, and numbers
+sql_literal_reg = re.compile(r"(?P<field>->>?\s*'(?:[^']|'')*')|E?'(?:[^']|'')*'|(?<![\w.$])\d+(?:\.\d+)?\b")
+#Lists of placeholders, such as IN (?, ?, ?)
+sql_list_reg = re.compile(r"\?(?:\s*,\s*\?)+")
+
+uuid_reg = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+def normalize_cql(cql):
+    """
+    Replace the literal terms of the CQL (barcodes, titles, ids, ...) with "?",
+    so that queries of the same shape are equal.
+    """
+    cql = uuid_reg.sub('?', cql)
+    cql = cql_term_reg.sub(lambda match: match.group('relation') + '?', cql)
+    cql = cql_quoted_reg.sub('?', cql)
+    cql = cql_repeat_reg.sub(lambda match: match.group('clause') + ' or ...', cql)
+    return ' '.join(cql.split())
+
+def normalize_sql(sql):
+    """
+    Replace the literals of the SQL (strings, numbers, offsets, limits, lists) with "?",
+    keeping the JSON field names, so that queries of the same shape are equal.
+    """
+    sql = sql_literal_reg.sub(lambda match: match.group('field') or '?', sql)
+    sql = sql_list_reg.sub('?, ...', sql)
+    return ' '.join(sql.split())
+
+@functools.lru_cache(maxsize=65536)
+def get_fingerprint(cql, sql):
+    """
+    The normalized CQL and SQL, and a stable fingerprint of that query shape.
+    """
+    normalized_cql = normalize_cql(cql)
+    normalized_sql = normalize_sql(sql)
+    digest = hashlib.sha1(f"{normalized_cql}\n{normalized_sql}".encode('utf-8')).hexdigest()
+    return digest[:16], normalized_cql, normalized_sql
+
 def get_dedup_list(original_seq):
-    original_list = list(original_seq)
-    original_list.sort(key = itemgetter(1))
-    groups = groupby(original_list, itemgetter(1))
-    grouped_list = [[item for item in data] for (key, data) in groups]
-    new_list = []
-    for entry in grouped_list:
-        new_list.append(max(entry, key=lambda x: x[0]))
-    return new_list
+    """
+    Keep the entry with the highest time for each CQL, sorted by CQL.
+    The entries are consumed as a stream, holding one entry per distinct CQL until the end,
+    so memory is not bounded: CQL with literal values (barcodes, UUIDs) is mostly distinct.
+    """
+    entries = {}
+    for entry in original_seq:
+        kept = entries.get(entry[1])
+        if kept is None or int(entry[0]) > int(kept[0]):
+            entries[entry[1]] = entry
+    return [entries[cql] for cql in sorted(entries)]
+
+#The relative width of the histogram buckets, for approximate percentiles
+HISTOGRAM_BASE = 1.02
+
+class QueryStats:
+    """
+    Statistics of the times (in microseconds) of one query.
+    The percentiles are estimated from a log-scale histogram, within 2%, so memory
+    does not grow with the number of occurrences.
+    example_sql: The SQL of one occurrence, when sql is normalized
+    """
+    __slots__ = ('fingerprint', 'cql', 'sql', 'example_sql', 'count', 'total', 'minimum', 'maximum',
+            'histogram')
+
+    def __init__(self, fingerprint, cql, sql, example_sql=None):
+        self.fingerprint = fingerprint
+        self.cql = cql
+        self.sql = sql
+        self.example_sql = example_sql or sql
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = {}
+
+    def add(self, time_us):
+        self.count += 1
+        self.total += time_us
+        if self.minimum is None or time_us < self.minimum:
+            self.minimum = time_us
+        if self.maximum is None or time_us > self.maximum:
+            self.maximum = time_us
+        bucket = int(math.log(time_us, HISTOGRAM_BASE)) if time_us > 0 else -1
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if self.minimum is None or other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if self.maximum is None or other.maximum > self.maximum:
+            self.maximum = other.maximum
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    def percentile(self, percent):
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                break
+        if bucket < 0:
+            return 0
+        return min(max(round(HISTOGRAM_BASE ** (bucket + 1)), self.minimum), self.maximum)
+
+#The columns of the aggregate report
+AGGREGATE_HEADER = ('fingerprint', 'count', 'total_us', 'min_us', 'max_us', 'mean_us', 'p95_us',
+        'cql', 'sql')
+
+#The metrics by which the aggregate report can be ranked
+AGGREGATE_SORT_KEYS = {
+    'total': lambda stats: stats.total,
+    'count': lambda stats: stats.count,
+    'mean': lambda stats: stats.mean,
+    'p95': lambda stats: stats.percentile(95),
+    'max': lambda stats: stats.maximum,
+}
+
+#The QueryRecord fields by which the aggregate report can be grouped
+AGGREGATE_GROUP_FIELDS = ('module', 'tenant', 'level', 'log_class')
+
+@functools.lru_cache(maxsize=4096)
+def get_time_bucket(minute, bucket_minutes):
+    """
+    The start of the bucket of bucket_minutes containing the minute (2023-06-01 12:07),
+    with the buckets aligned to midnight.
+    """
+    start = datetime.fromisoformat(minute)
+    start -= timedelta(minutes=(start.hour * 60 + start.minute) % bucket_minutes)
+    return start.strftime('%Y-%m-%d %H:%M')
+
+class QueryAggregator:
+    """
+    Aggregate the entries as a stream, holding one QueryStats per distinct query.
+    key: 'cql' to group by the CQL, 'sql' to group by the SQL (with whitespace collapsed),
+      or 'fingerprint' to group by the query shape (see normalize_cql and normalize_sql)
+    group_by: QueryRecord fields (see AGGREGATE_GROUP_FIELDS) to also group by, such as ('module',)
+    bucket: The minutes of the time buckets to also group by, from the timestamp of the entries
+    """
+    def __init__(self, key='cql', group_by=(), bucket=None):
+        self.key = key
+        self.group_by = tuple(group_by)
+        self.bucket = bucket
+        self.queries = {}
+
+    def get_group(self, entry):
+        group = tuple(getattr(entry, field) or '' for field in self.group_by)
+        if self.bucket:
+            bucket = get_time_bucket(entry.timestamp[:16], self.bucket) if entry.timestamp else ''
+            group = (bucket,) + group
+        return group
+
+    def get_header(self):
+        """
+        The columns of the report: the bucket and group_by fields, followed by AGGREGATE_HEADER.
+        """
+        return (('bucket',) if self.bucket else ()) + self.group_by + AGGREGATE_HEADER
+
+    def add(self, entry):
+        time, cql, sql = entry[:3]
+        example_sql = sql
+        if self.key == 'fingerprint':
+            query_key, cql, sql = get_fingerprint(cql, sql)
+        elif self.key == 'cql':
+            query_key = cql
+        else:
+            query_key = ' '.join(sql.split())
+        if self.group_by or self.bucket:
+            query_key = (self.get_group(entry), query_key)
+        stats = self.queries.get(query_key)
+        if stats is None:
+            fingerprint = get_fingerprint(cql, sql)[0] if self.key == 'fingerprint' else None
+            stats = self.queries[query_key] = QueryStats(fingerprint, cql, sql, example_sql)
+        stats.add(int(time))
+
+    def add_all(self, entries):
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def get_ranked(self, sort_by='total', top=None):
+        """
+        The (group, statistics) ranked by the metric, highest first (e.g. slowest or most frequent).
+        With group_by or bucket, the groups are in order, and the top entries are ranked within each group.
+        """
+        sort_key = AGGREGATE_SORT_KEYS[sort_by]
+        groups = {}
+        for query_key, stats in self.queries.items():
+            group = query_key[0] if self.group_by or self.bucket else ()
+            groups.setdefault(group, []).append(stats)
+        ranked = []
+        for group in sorted(groups):
+            group_ranked = sorted(groups[group], key=sort_key, reverse=True)
+            ranked.extend((group, stats) for stats in (group_ranked[:top] if top else group_ranked))
+        return ranked
+
+    def get_report(self, sort_by='total', top=None, explainer=None):
+        """
+        The ranked statistics as rows, matching get_header(),
+        followed by the EXPLAIN_HEADER columns of the explainer (a PlanExplainer) where given.
+        """
+        report = []
+        for group, stats in self.get_ranked(sort_by, top):
+            fingerprint = stats.fingerprint or get_fingerprint(stats.cql, stats.sql)[0]
+            row = group + (fingerprint, stats.count, stats.total, stats.minimum, stats.maximum,
+                    round(stats.mean), stats.percentile(95), stats.cql, stats.sql)
+            if explainer:
+                row += explainer.get_columns(fingerprint, stats.example_sql)
+            report.append(row)
+        return report
+
+#The columns of the aggregate report added by a PlanExplainer
+EXPLAIN_HEADER = ('plan_cost', 'seq_scans', 'index_candidates', 'plan_error')
+
+def get_plan_findings(plan):
+    """
+    The (total cost, relations read by sequential scans, missing index candidates) of an
+    EXPLAIN (FORMAT JSON) plan. The candidates are the sequential scans with a filter,
+    as "relation: filter".
+    """
+    seq_scans = []
+    candidates = []
+    nodes = [plan['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node.get('Node Type') == 'Seq Scan':
+            relation = node.get('Relation Name', '')
+            if node.get('Schema'):
+                relation = f"{node['Schema']}.{relation}"
+            seq_scans.append(relation)
+            if node.get('Filter'):
+                candidates.append(f"{relation}: {node['Filter']}")
+        nodes.extend(reversed(node.get('Plans', ())))
+    return (plan['Plan'].get('Total Cost'), seq_scans, candidates)
+
+class PlanExplainer:
+    """
+    Explain the SQL of the query shapes against a PostgreSQL database (without running it),
+    caching the plans by fingerprint, and in the JSON file cache_path between runs where given.
+    dsn: A libpq connection string, such as "dbname=folio host=localhost"
+    limit: The number of distinct fingerprints to explain, in the order they are asked for
+    timeout_ms: The statement timeout of each EXPLAIN
+    """
+    def __init__(self, dsn, cache_path=None, limit=20, timeout_ms=5000):
+        if psycopg is None:
+            raise RuntimeError("The psycopg module is required to explain queries")
+        self.dsn = dsn
+        self.cache_path = cache_path
+        self.limit = limit
+        self.timeout_ms = timeout_ms
+        self.plans = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                self.plans = json.load(cache_file)
+        self.errors = {}
+        self.explained = set()
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = psycopg.connect(self.dsn)
+
+    def explain(self, fingerprint, sql):
+        """
+        The plan of the SQL, or raise a psycopg.Error.
+        """
+        if fingerprint in self.plans:
+            return self.plans[fingerprint]
+        if fingerprint in self.errors:
+            raise self.errors[fingerprint]
+        self.connect()
+        try:
+            with self.connection.cursor() as cursor:
+                # Nothing is written, even if the SQL is not a SELECT
+                cursor.execute("SET TRANSACTION READ ONLY")
+                cursor.execute(f"SET LOCAL statement_timeout = {int(self.timeout_ms)}")
+                # Prepared, so that only a single statement is accepted: SQL from the log
+                # such as "...; COMMIT; ..." fails rather than ending the read only transaction
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, prepare=True)
+                plan = cursor.fetchone()[0][0]
+        except psycopg.Error as e:
+            self.errors[fingerprint] = e
+            raise
+        finally:
+            self.connection.rollback()
+        self.plans[fingerprint] = plan
+        return plan
+
+    def get_columns(self, fingerprint, sql):
+        """
+        The EXPLAIN_HEADER columns of the query shape, which are empty beyond the limit.
+        """
+        if fingerprint not in self.explained:
+            if len(self.explained) >= self.limit:
+                return ('', '', '', '')
+            self.explained.add(fingerprint)
+        if fingerprint not in self.plans:
+            # Fail on a connection error, rather than reporting it for each query
+            self.connect()
+        try:
+            cost, seq_scans, candidates = get_plan_findings(self.explain(fingerprint, sql))
+        except psycopg.Error as e:
+            return ('', '', '', ' '.join(str(e).split()))
+        return (cost, ';'.join(seq_scans), ';'.join(candidates), '')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.cache_path:
+            with open(self.cache_path, 'w') as cache_file:
+                json.dump(self.plans, cache_file)
 
 
 def get_queries_from_logfile(log_handle, max_lines=4, dedup=False, debug=False):
-    log_reg = r"(?P<date>\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d,\d+)\s+(?P<level>\S+)\s+(?P<class>\S+)\s+(?P<module>\S+)\s(?P<body>.*)" #Match the major pieces of a log entry
-    result_list = []
-    line = log_handle.readline()
-    while line:
+    result_list = list(iter_queries_from_logfile(log_handle, max_lines, debug))
+    if dedup:
+        result_list = get_dedup_list(result_list)
+    return result_list
+
+def iter_queries_from_logfile(log_handle, max_lines=4, debug=False, start=None, end=None, details=True):
+    """
+    Generate the QueryRecord entries as they are found.
+    Each line is read once, and the entries waiting for their SQL and time are kept pending,
+    so that the lines of concurrent requests may be interleaved. The SQL and time lines are
+    matched to the pending entries by request id where present, else to the oldest entry.
+    log_handle: An open handle to a log file that we're searching
+    max_lines: The maximum number of lines to scan for SQL following finding CQL
+      (and TIME_SCAN_LINES for the time following the SQL, or REQUEST_SCAN_LINES for both when
+      correlated by request id)
+    start, end: When parsing a chunk of the log, log_handle is a MappedLogHandle, and only the
+      entries whose CQL line starts within these byte offsets are generated
+    details: Derive the fields of the log line (see get_query_record), else only the time, CQL and SQL
+    """
+    pending = []
+    emit = starting = True
+    for line_number, line in enumerate(iter(log_handle.readline, ''), 1):
+        if end is not None:
+            starting = log_handle.line_start < end
+            if not starting:
+                pending = [entry for entry in pending if entry.deadline >= line_number]
+                if not pending:
+                    break
+            emit = log_handle.line_start >= start
+        if pending:
+            #the expired entries are only removed before matching a time or SQL line
+            time_match = time_reg.match(line) if "ProxyContext" in line else None
+            if time_match:
+                pending = [entry for entry in pending if entry.deadline >= line_number]
+                found = find_pending(pending, time_match.group('request_id'),
+                        lambda entry: entry.sql)
+                if found:
+                    entry = found[0]
+                    pending.remove(entry)
+                    if entry.emit:
+                        if details:
+                            yield get_query_record(time_match, entry.cql, entry.sql, entry.line,
+                                    entry.line_match)
+                        else:
+                            yield QueryRecord(time_match.group('time'), entry.cql, entry.sql)
+                        if debug:
+                            print("Got match from legacy reg" if entry.line_match
+                                    else "Got match from unified reg")
+                    continue
+            #all the SQL patterns contain "SQL"
+            elif "SQL" in line:
+                pending = [entry for entry in pending if entry.deadline >= line_number]
+                found = find_pending(pending, get_context_request_id(line),
+                        lambda entry: get_sql(entry.sql_regs, line) if entry.sql is None else None)
+                if found:
+                    entry, entry.sql = found
+                    entry.deadline = line_number + (REQUEST_SCAN_LINES if entry.request_id
+                            else TIME_SCAN_LINES)
+                    continue
+        #cheaply skip the lines which cannot start a CQL entry
+        if not starting or ("CQL" not in line and "CqlHelper" not in line):
+            continue
          #try the unified reg first
-        unified_match = re.match(unified_sql_cql_reg, line)
+        unified_match = unified_sql_cql_reg.match(line)
         if unified_match:
-            time = get_time(log_handle)
-            if time:
-                result_list.append( (time, unified_match.group(1), unified_match.group(2)) )
-                line = log_handle.readline() #force next read
-                if debug:
-                    print("Got match from unified reg")
-                continue
-        line_match = re.match(log_reg, line)
+            cql, sql = unified_match.group(1, 2)
+            entry = PendingQuery(cql, sql, None, line, None, line_number + TIME_SCAN_LINES, emit)
+            if entry.request_id:
+                entry.deadline = line_number + REQUEST_SCAN_LINES
+            pending.append(entry)
+            continue
+        line_match = log_reg.match(line)
         if not line_match:
-            line = log_handle.readline()
             continue
-        for pair in cql_to_sql_reg_pairs:
-            cql_reg = pair[0]
-            cql_match = re.match(cql_reg, line_match.group('body')) #try to see if the logline matches a CQL pattern
+        for cql_reg, sql_regs in cql_to_sql_reg_pairs:
+            cql_match = cql_reg.match(line_match.group('body')) #try to see if the logline matches a CQL pattern
             if cql_match:
-                sql = get_sql(pair[1], log_handle, max_lines)
-                if sql:
-                    time = get_time(log_handle)
-                    if time:
-                        result_list.append( (time, cql_match.group(1), sql) )
-                        if debug:
-                            print("Got match from legacy reg")
-        line = log_handle.readline()
+                entry = PendingQuery(cql_match.group(1), None, sql_regs, line, line_match,
+                        line_number + max_lines, emit)
+                if entry.request_id:
+                    entry.deadline = line_number + REQUEST_SCAN_LINES
+                pending.append(entry)
+                break
+
+class MappedLogHandle:
+    """
+    A log_handle over a memory-mapped log file, which records where the last line read starts.
+    """
+    def __init__(self, log_map, pos):
+        self.log_map = log_map
+        self.log_map.seek(pos)
+        self.line_start = pos
+
+    def readline(self):
+        self.line_start = self.log_map.tell()
+        return self.log_map.readline().decode('utf-8', errors='replace')
+
+def get_chunk_queries(chunk):
+    """
+    Parse the entries starting within one chunk of the log, in a worker process.
+    Parsing begins before the chunk, by the most lines an entry can be pending (the overlap
+    window), so that the SQL and time lines of the entries pending from the previous chunk
+    are matched to them rather than to the entries of this chunk, and continues past the end
+    of the chunk until the last entries are complete. The output is the same as a sequential
+    parse unless the entries pending at the start of the window affect the matching within it.
+    """
+    log_file_path, start, end, max_lines, debug, details = chunk
+    with open(log_file_path, 'rb') as log_file, \
+            mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+        pos = start
+        # An entry correlated by request id waits up to REQUEST_SCAN_LINES for its SQL,
+        # and as long again for its time
+        for _ in range(max(max_lines, REQUEST_SCAN_LINES) + REQUEST_SCAN_LINES):
+            if pos == 0:
+                break
+            pos = log_map.rfind(b"\n", 0, pos - 1) + 1
+        log_handle = MappedLogHandle(log_map, pos)
+        return list(iter_queries_from_logfile(log_handle, max_lines, debug, start, end, details))
+
+def get_chunks(log_file_path, chunk_count, max_lines=4, debug=False, details=True):
+    """
+    Split the log into byte ranges at line boundaries.
+    """
+    size = os.path.getsize(log_file_path)
+    chunk_size = max(size // chunk_count, MIN_CHUNK_SIZE)
+    chunks = []
+    with open(log_file_path, 'rb') as log_file, \
+            mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+        start = 0
+        while start < size:
+            end = log_map.find(b"\n", min(start + chunk_size, size) - 1) + 1 or size
+            chunks.append( (log_file_path, start, end, max_lines, debug, details) )
+            start = end
+    return chunks
+
+def get_queries_parallel(log_file_path, max_lines=4, dedup=False, debug=False, workers=None):
+    result_list = list(iter_queries_parallel(log_file_path, max_lines, debug, workers))
     if dedup:
         result_list = get_dedup_list(result_list)
     return result_list
 
-def get_query_csv(log_file_path, csv_file_path, max_lines=4, dedup=False, debug=False):
-    with open(log_file_path, 'r') as log_handle:
-        result_list = get_queries_from_logfile(log_handle, max_lines, dedup, debug)
-        with open(csv_file_path, 'w', newline='') as csv_handle:
-            csv_writer = csv.writer(csv_handle)
-            for entry in result_list:
-                csv_writer.writerow(entry)
+def iter_queries_parallel(log_file_path, max_lines=4, debug=False, workers=None, details=True):
+    """
+    Parse the log in chunks with a pool of worker processes,
+    generating the entries in their original order as each chunk completes.
+    workers: The number of processes (default: the number of CPUs)
+    """
+    workers = workers or os.cpu_count()
+    if os.path.getsize(log_file_path) == 0:
+        return
+    # Several chunks per worker, to balance the load
+    chunks = get_chunks(log_file_path, workers * 4, max_lines, debug, details)
+    with multiprocessing.Pool(workers) as pool:
+        for chunk_list in pool.imap(get_chunk_queries, chunks):
+            yield from chunk_list
+
+class FollowLogHandle:
+    """
+    A log_handle which tails a growing log file, waiting for complete lines,
+    and reopening the file when it is rotated (moved or truncated).
+    on_tick: Called every tick_lines lines, and while waiting for more lines
+    """
+    def __init__(self, log_file_path, on_tick=None, poll_interval=0.5, from_start=False, tick_lines=1000):
+        self.log_file_path = log_file_path
+        self.on_tick = on_tick
+        self.poll_interval = poll_interval
+        self.tick_lines = tick_lines
+        self.lines = 0
+        self.log_file = open(log_file_path, 'r', encoding='utf-8', errors='replace')
+        if not from_start:
+            self.log_file.seek(0, os.SEEK_END)
+        self.partial = ''
 
+    def readline(self):
+        while True:
+            line = self.log_file.readline()
+            if line.endswith('\n'):
+                line = self.partial + line
+                self.partial = ''
+                self.lines += 1
+                if self.on_tick and self.lines % self.tick_lines == 0:
+                    self.on_tick()
+                return line
+            self.partial += line
+            if not line:
+                if self.is_rotated():
+                    self.log_file.close()
+                    self.log_file = open(self.log_file_path, 'r', encoding='utf-8', errors='replace')
+                    # an unterminated line of the old file is not continued by the new one
+                    self.partial = ''
+                    continue
+                if self.on_tick:
+                    self.on_tick()
+                time.sleep(self.poll_interval)
 
-if __name__ == "__main__":
+    def is_rotated(self):
+        try:
+            stat = os.stat(self.log_file_path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino != os.fstat(self.log_file.fileno()).st_ino
+                or stat.st_size < self.log_file.tell())
+
+    def close(self):
+        self.log_file.close()
+
+class RollingStats:
+    """
+    Statistics per query shape (fingerprint) over rolling windows of recent minutes,
+    kept as per-minute QueryStats so memory is bounded by the longest window.
+    """
+    def __init__(self, windows=(1, 5, 15)):
+        self.windows = windows
+        self.minutes = deque()
+
+    def add(self, entry, now=None):
+        minute = int((now or time.time()) // 60)
+        if not self.minutes or self.minutes[-1][0] != minute:
+            self.minutes.append( (minute, {}) )
+        while self.minutes[0][0] <= minute - max(self.windows):
+            self.minutes.popleft()
+        fingerprint, cql, sql = get_fingerprint(entry[1], entry[2])
+        queries = self.minutes[-1][1]
+        stats = queries.get(fingerprint)
+        if stats is None:
+            stats = queries[fingerprint] = QueryStats(fingerprint, cql, sql)
+        stats.add(int(entry[0]))
+
+    def get_window(self, window, now=None):
+        """
+        The merged QueryStats per fingerprint over the last window minutes.
+        """
+        minute = int((now or time.time()) // 60)
+        merged = {}
+        for entry_minute, queries in self.minutes:
+            if entry_minute <= minute - window:
+                continue
+            for fingerprint, stats in queries.items():
+                if fingerprint not in merged:
+                    merged[fingerprint] = QueryStats(fingerprint, stats.cql, stats.sql)
+                merged[fingerprint].merge(stats)
+        return merged
+
+    def get_table(self, sort_by='total', top=20, now=None):
+        """
+        Rows of the count and p95 time over each window, ranked by the metric over the middle window.
+        """
+        by_window = [self.get_window(window, now) for window in self.windows]
+        ranking = by_window[len(by_window) // 2]
+        ranked = sorted(ranking.values(), key=AGGREGATE_SORT_KEYS[sort_by], reverse=True)[:top]
+        header = ['fingerprint']
+        header.extend(f"count_{window}m" for window in self.windows)
+        header.extend(f"p95_us_{window}m" for window in self.windows)
+        header.append('cql')
+        rows = [header]
+        for stats in ranked:
+            windows_stats = [queries.get(stats.fingerprint) for queries in by_window]
+            row = [stats.fingerprint]
+            row.extend(str(ws.count if ws else 0) for ws in windows_stats)
+            row.extend(str(ws.percentile(95) if ws else '') for ws in windows_stats)
+            row.append(stats.cql)
+            rows.append(row)
+        return rows
+
+def print_table(rows, out=sys.stdout, max_width=160):
+    """
+    Print the rows as aligned columns, refreshing the screen of a terminal.
+    """
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    if out.isatty():
+        out.write("\x1b[2J\x1b[H")
+    out.write(time.strftime('%Y-%m-%d %H:%M:%S') + "\n")
+    for row in rows:
+        line = '  '.join(cell.rjust(width) for cell, width in zip(row, widths))
+        out.write(f"{line}  {row[-1]}"[:max_width] + "\n")
+    out.flush()
+
+def follow_queries(log_file_path, max_lines=4, debug=False, sort_by='total', top=20, refresh=5):
+    """
+    Tail the log, printing a table of the top query shapes over rolling windows
+    every refresh seconds, until interrupted. The time is checked every 1000 lines,
+    so the table is refreshed also on a busy log with few queries.
+    """
+    rolling = RollingStats()
+    next_refresh = time.monotonic() + refresh
+
+    def refresh_table():
+        nonlocal next_refresh
+        if time.monotonic() >= next_refresh:
+            print_table(rolling.get_table(sort_by, top))
+            next_refresh = time.monotonic() + refresh
+
+    log_handle = FollowLogHandle(log_file_path, on_tick=refresh_table)
+    try:
+        for entry in iter_queries_from_logfile(log_handle, max_lines, debug, details=False):
+            rolling.add(entry)
+            refresh_table()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_handle.close()
+
+#The leading bytes of the compressed formats
+COMPRESSION_MAGIC = (
+    (b"\x1f\x8b", 'gzip'),
+    (b"BZh", 'bz2'),
+    (b"\xfd7zXZ\x00", 'xz'),
+    (b"\x28\xb5\x2f\xfd", 'zstd'),
+)
+
+def get_compression(log_file_path):
+    """
+    The compression format of the log file, from its leading bytes, or None.
+    """
+    with open(log_file_path, 'rb') as log_file:
+        head = log_file.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def open_log(log_file_path):
+    """
+    Open the log file for reading text, decompressing gzip, bz2, xz and zstd
+    (if the zstandard module is installed) on the fly.
+    """
+    compression = get_compression(log_file_path)
+    if compression is None:
+        return open(log_file_path, 'r', encoding='utf-8', errors='replace')
+    if compression == 'gzip':
+        return gzip.open(log_file_path, 'rt', encoding='utf-8', errors='replace')
+    if compression == 'bz2':
+        return bz2.open(log_file_path, 'rt', encoding='utf-8', errors='replace')
+    if compression == 'xz':
+        return lzma.open(log_file_path, 'rt', encoding='utf-8', errors='replace')
+    if zstandard is None:
+        raise RuntimeError(f"The zstandard module is required to read {log_file_path}")
+    log_file = open(log_file_path, 'rb')
+    reader = zstandard.ZstdDecompressor().stream_reader(log_file, closefd=True)
+    return io.TextIOWrapper(io.BufferedReader(reader), encoding='utf-8', errors='replace')
+
+def get_log_paths(log_file_patterns):
+    """
+    Expand the paths, directories (of rotated logs) and glob patterns into log file paths.
+    """
+    log_file_paths = []
+    for pattern in log_file_patterns:
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+            paths = [path for path in paths if os.path.isfile(path)]
+        elif os.path.exists(pattern):
+            paths = [pattern]
+        else:
+            paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise FileNotFoundError(f"No log files found for: {pattern}")
+        log_file_paths.extend(path for path in paths if path not in log_file_paths)
+    return log_file_paths
+
+def get_first_timestamp(log_file_path, max_lines=1000):
+    """
+    The timestamp of the first log entry in the file, or None.
+    """
+    with open_log(log_file_path) as log_handle:
+        for _ in range(max_lines):
+            line = log_handle.readline()
+            if not line:
+                break
+            line_match = log_reg.match(line)
+            if line_match:
+                return line_match.group('date')
+    return None
+
+def order_log_paths(log_file_paths):
+    """
+    Order the log files (e.g. rotated logs) by the timestamp of their first entry.
+    """
+    timestamps = {path: get_first_timestamp(path) for path in log_file_paths}
+    return sorted(log_file_paths, key=lambda path: (timestamps[path] is None, timestamps[path] or ''))
+
+def get_file_queries(file_args):
+    """
+    Parse one whole log file, in a worker process.
+    """
+    log_file_path, max_lines, debug, details = file_args
+    with open_log(log_file_path) as log_handle:
+        return list(iter_queries_from_logfile(log_handle, max_lines, debug, details=details))
+
+def iter_queries_from_logs(log_file_patterns, max_lines=4, debug=False, workers=1, details=True):
+    """
+    Generate the entries of the log files, in the order of their timestamps.
+    log_file_patterns: Paths, directories or glob patterns of (possibly compressed) log files
+    workers: The number of processes, which parse several files in parallel, or a single
+      uncompressed file in chunks (0 or None for the number of CPUs)
+    """
+    log_file_paths = order_log_paths(get_log_paths(log_file_patterns))
+    if workers == 1:
+        for log_file_path in log_file_paths:
+            with open_log(log_file_path) as log_handle:
+                yield from iter_queries_from_logfile(log_handle, max_lines, debug, details=details)
+    elif len(log_file_paths) == 1 and get_compression(log_file_paths[0]) is None:
+        yield from iter_queries_parallel(log_file_paths[0], max_lines, debug, workers, details)
+    else:
+        workers = min(workers or os.cpu_count(), len(log_file_paths))
+        file_args = [(log_file_path, max_lines, debug, details) for log_file_path in log_file_paths]
+        with multiprocessing.Pool(workers) as pool:
+            for file_list in pool.imap(get_file_queries, file_args):
+                yield from file_list
+
+def iter_queries(source, max_lines=4, debug=False, workers=1, details=True):
+    """
+    Generate the QueryRecord entries of the source, as they are found.
+    source: An open log handle (anything with a readline method), or a path, directory or glob
+      pattern of (possibly compressed) log files, or a list of them
+    details: Derive the fields of the log line, else only the time, CQL and SQL (which is faster)
+    """
+    if hasattr(source, 'readline'):
+        return iter_queries_from_logfile(source, max_lines, debug, details=details)
+    if isinstance(source, (str, os.PathLike)):
+        source = [source]
+    return iter_queries_from_logs([os.fspath(path) for path in source], max_lines, debug, workers,
+            details)
+
+#The columns of the SQLite and Parquet outputs
+OUTPUT_COLUMNS = ('timestamp', 'level', 'log_class', 'module', 'tenant', 'request_id', 'time_us',
+        'fingerprint', 'cql', 'sql')
+
+#The output formats by file extension
+OUTPUT_FORMATS = {'.db': 'sqlite', '.sqlite': 'sqlite', '.sqlite3': 'sqlite', '.parquet': 'parquet'}
+
+def get_output_format(output_path):
+    return OUTPUT_FORMATS.get(os.path.splitext(output_path)[1].lower(), 'csv')
+
+def iter_output_rows(entries):
+    """
+    Generate the rows of OUTPUT_COLUMNS for the entries.
+    """
+    for entry in entries:
+        yield (entry.timestamp, entry.level, entry.log_class, entry.module, entry.tenant,
+                entry.request_id, int(entry.time), get_fingerprint(entry.cql, entry.sql)[0],
+                entry.cql, entry.sql)
+
+def iter_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def write_sqlite(entries, db_path, batch_size=10000):
+    """
+    Write the entries to a new SQLite database, in the table "queries" indexed by
+    fingerprint and timestamp, with the normalized query of each fingerprint in "query_shapes".
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    connection = sqlite3.connect(db_path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE queries (id INTEGER PRIMARY KEY, timestamp TEXT, level TEXT, "
+                "log_class TEXT, module TEXT, tenant TEXT, request_id TEXT, time_us INTEGER, "
+                "fingerprint TEXT, cql TEXT, sql TEXT)")
+        connection.execute("CREATE TABLE query_shapes (fingerprint TEXT PRIMARY KEY, cql TEXT, sql TEXT)")
+        insert = f"INSERT INTO queries ({', '.join(OUTPUT_COLUMNS)}) VALUES ({', '.join('?' * len(OUTPUT_COLUMNS))})"
+        shapes = {}
+        with connection:
+            for batch in iter_batches(iter_output_rows(entries), batch_size):
+                connection.executemany(insert, batch)
+                for row in batch:
+                    if row[7] not in shapes:
+                        shapes[row[7]] = get_fingerprint(row[8], row[9])[1:]
+            connection.executemany("INSERT INTO query_shapes VALUES (?, ?, ?)",
+                    ((fingerprint, cql, sql) for fingerprint, (cql, sql) in shapes.items()))
+            # Indexing after loading is faster than maintaining the indexes during the inserts
+            connection.execute("CREATE INDEX queries_fingerprint ON queries (fingerprint)")
+            connection.execute("CREATE INDEX queries_timestamp ON queries (timestamp)")
+    finally:
+        connection.close()
+
+def write_parquet(entries, parquet_path, batch_size=100000):
+    """
+    Write the entries to a Parquet file in row groups of batch_size, using pyarrow.
+    """
+    if pyarrow is None:
+        raise RuntimeError("The pyarrow module is required to write Parquet")
+    schema = pyarrow.schema([
+        ('timestamp', pyarrow.timestamp('ms')),
+        ('level', pyarrow.string()),
+        ('log_class', pyarrow.string()),
+        ('module', pyarrow.string()),
+        ('tenant', pyarrow.string()),
+        ('request_id', pyarrow.string()),
+        ('time_us', pyarrow.int64()),
+        ('fingerprint', pyarrow.string()),
+        ('cql', pyarrow.string()),
+        ('sql', pyarrow.string()),
+    ])
+    with pyarrow.parquet.ParquetWriter(parquet_path, schema) as writer:
+        for batch in iter_batches(iter_output_rows(entries), batch_size):
+            columns = [list(column) for column in zip(*batch)]
+            columns[0] = [datetime.fromisoformat(timestamp) if timestamp else None
+                    for timestamp in columns[0]]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+
+def check_output_path(output_path, log_file_patterns):
+    """
+    Raise a ValueError if the output path is one of the log files, or an existing log or
+    compressed file, such as when the output path was left out after a glob of rotated logs.
+    """
+    log_file_paths = [os.path.abspath(path) for path in get_log_paths(log_file_patterns)]
+    if os.path.abspath(output_path) in log_file_paths:
+        raise ValueError(f"The output path is one of the log files: {output_path}")
+    if os.path.isfile(output_path) and (get_compression(output_path) is not None
+            or get_first_timestamp(output_path) is not None):
+        raise ValueError(f"The output path is an existing log file: {output_path}")
+
+def get_query_csv(log_file_path, csv_file_path, max_lines=4, dedup=False, debug=False, workers=1,
+        aggregate=None, sort_by='total', top=None, output_format=None, group_by=(), bucket=None,
+        explainer=None):
+    """
+    Write the entries to the CSV file as they are found, so memory use does not grow
+    with the size of the log (with dedup, it grows with the number of distinct CQL).
+    log_file_path: The path of the log, or a list of paths, directories or glob patterns
+      of (possibly compressed) log files
+    aggregate: Instead write a ranked report of the statistics per query,
+      grouped by 'cql', 'sql' or 'fingerprint', ranked by sort_by, and limited to the top entries
+      (within each group of the group_by fields and time bucket of minutes, where given),
+      with the plan findings of the top query shapes from the explainer (a PlanExplainer) where given
+    output_format: 'csv', or 'sqlite' or 'parquet' with the log fields of each entry
+      (default: from the extension of csv_file_path)
+    """
+    if isinstance(log_file_path, str):
+        log_file_path = [log_file_path]
+    check_output_path(csv_file_path, log_file_path)
+    output_format = output_format or get_output_format(csv_file_path)
+    # the fields of the log line are only derived when they are written or grouped by
+    details = bool(group_by or bucket) if aggregate else output_format in ('sqlite', 'parquet')
+    entries = iter_queries_from_logs(log_file_path, max_lines, debug, workers, details)
+    if dedup:
+        entries = get_dedup_list(entries)
+    if output_format == 'sqlite' and not aggregate:
+        write_sqlite(entries, csv_file_path)
+        return
+    if output_format == 'parquet' and not aggregate:
+        write_parquet(entries, csv_file_path)
+        return
+    with open(csv_file_path, 'w', newline='') as csv_handle:
+        csv_writer = csv.writer(csv_handle)
+        if aggregate:
+            aggregator = QueryAggregator(aggregate, group_by, bucket).add_all(entries)
+            csv_writer.writerow(aggregator.get_header() + (EXPLAIN_HEADER if explainer else ()))
+            csv_writer.writerows(aggregator.get_report(sort_by, top, explainer))
+            return
+        csv_writer.writerows(entry[:3] for entry in entries)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Parse out cql and sql information from an Okapi logfile')
     parser.add_argument('--max-sql-scan-lines', type=int, action='store',\
             default=4, help="The number of lines to scan for SQL following finding CQL")
     parser.add_argument('--debug', type=bool, action='store', default=False, help="Debug mode")
-    parser.add_argument('--dedup', type=bool, action='store', default=False, help="Remove duplicate CQL entries")
-    parser.add_argument('logfile', help="The path to the Okapi logfile")
-    parser.add_argument('csvfile', help="A path to write the csv output to")
+    parser.add_argument('--dedup', type=bool, action='store', default=False, help="Remove duplicate CQL entries "
+            "(holds one entry per distinct CQL, so memory grows with the log; "
+            "see --aggregate=fingerprint for a bounded summary)")
+    parser.add_argument('--workers', type=int, action='store', default=1,\
+            help="The number of processes for parallel parsing (0 for the number of CPUs)")
+    parser.add_argument('--aggregate', choices=('cql', 'sql', 'fingerprint'), action='store',\
+            default=None, help="Write a ranked report of count, total, min, max, mean and p95 time "
+            "per query, grouped by CQL, by SQL, or by query shape (fingerprint)")
+    parser.add_argument('--sort-by', choices=tuple(AGGREGATE_SORT_KEYS), action='store',\
+            default='total', help="The metric by which the aggregate report is ranked")
+    parser.add_argument('--top', type=int, action='store', default=None,\
+            help="The number of queries in the aggregate report or the follow table")
+    parser.add_argument('--group-by', choices=AGGREGATE_GROUP_FIELDS, action='append', default=[],\
+            help="Also group the aggregate report by this field of the log line (may be repeated)")
+    parser.add_argument('--bucket', type=int, action='store', default=None,\
+            help="Also group the aggregate report by time buckets of this many minutes")
+    parser.add_argument('--explain', metavar='DSN', action='store', default=None,\
+            help="Add the EXPLAIN plan cost, sequential scans and missing index candidates of the top "
+            "queries to the aggregate report, from the PostgreSQL of this libpq connection string "
+            "(requires the psycopg module)")
+    parser.add_argument('--explain-top', type=int, action='store', default=20,\
+            help="The number of query shapes of the aggregate report to explain")
+    parser.add_argument('--explain-cache', action='store', default=None,\
+            help="A JSON file caching the plans by fingerprint between runs")
+    parser.add_argument('--format', choices=('csv', 'sqlite', 'parquet'), action='store', default=None,\
+            help="The output format, where sqlite and parquet include the timestamp, level, class, module, "
+            "tenant, request id and fingerprint of each entry (default: from the extension of the output path)")
+    parser.add_argument('--follow', action='store_true', default=False,\
+            help="Tail the growing logfile, printing the top query shapes over the last 1, 5 and 15 minutes")
+    parser.add_argument('--refresh', type=float, action='store', default=5,\
+            help="The number of seconds between refreshes of the follow table")
+    parser.add_argument('paths', nargs='+', metavar='logfile', help="The paths to the Okapi logfiles "
+            "(possibly compressed with gzip, bz2, xz or zstd), or directories or glob patterns of "
+            "rotated logfiles, followed by a path to write the csv output to (except with --follow)")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.follow and len(args.paths) != 1:
+        parser.error("--follow requires a single logfile")
+    if not args.follow and len(args.paths) < 2:
+        parser.error("the following arguments are required: csvfile")
+    if args.aggregate and args.format in ('sqlite', 'parquet'):
+        parser.error("--aggregate writes csv")
+    if (args.group_by or args.bucket) and not args.aggregate:
+        parser.error("--group-by and --bucket require --aggregate")
+    if args.explain and not args.aggregate:
+        parser.error("--explain requires --aggregate")
+    if args.bucket is not None and args.bucket <= 0:
+        parser.error("--bucket must be a positive number of minutes")
+    explainer = None
     try:
-        get_query_csv(args.logfile, args.csvfile, args.max_sql_scan_lines, args.dedup, args.debug)
+        if args.explain:
+            explainer = PlanExplainer(args.explain, args.explain_cache, args.explain_top)
+        if args.follow:
+            follow_queries(args.paths[0], args.max_sql_scan_lines, args.debug, args.sort_by,
+                    args.top or 20, args.refresh)
+        else:
+            get_query_csv(args.paths[:-1], args.paths[-1], args.max_sql_scan_lines, args.dedup,
+                    args.debug, args.workers, args.aggregate, args.sort_by, args.top, args.format,
+                    args.group_by, args.bucket, explainer)
     except Exception as e:
         if(args.debug):
             raise e
         sys.stderr.write(f"Error processing logs: {e}\n")
         sys.exit(1)
+    finally:
+        if explainer:
+            explainer.close()
 
-
-
-
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Write a deterministic synthetic Okapi log file, for benchmarks.
+
+usage: python synthetic_log.py [--size-mb 100] [--noise-ratio 0.9] [--formats cql-query,cqlhelper,unified]
+    [--seed 1] path_to_log_file
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta
+
+NOISE_LINES = (
+    "{date} INFO  LogUtil              mod-users 10.0.0.1:54321 GET /users?limit=10 200 4ms\n",
+    "{date} DEBUG PostgresClient       mod-inventory-storage Executing query: SELECT 1\n",
+    "{date} INFO  RestVerticle         mod-circulation invoking getCirculationLoans\n",
+    "{date} WARN  PgUtil               mod-inventory-storage Slow connection acquired in 120 ms\n",
+    "{date} INFO  ProxyContext         {n}/users RES 200 {us}us mod-users-19.0.0 /users/{n}\n",
+)
+
+#The query blocks of each log format: the CQL, SQL and ProxyContext time lines of one request
+QUERY_FORMATS = {
+    'cql-query': (
+        "{date} INFO  CQLWrapper           mod-inventory-storage CQL query: title=\"book{n}\"\n"
+        "{date} INFO  CQLWrapper           mod-inventory-storage SQL generated from CQL: "
+        "SELECT * FROM instance WHERE title = 'book{n}'\n"
+        "{date} INFO  ProxyContext         {n}/instance-storage RES 200 {us}us "
+        "mod-inventory-storage-19.0.0 /instance-storage/instances\n"),
+    'cqlhelper': (
+        "{date} INFO  CqlHelper            mod-users CqlHelper Encoding query barcode=={n}\n"
+        "{date} INFO  CqlHelper            mod-users SQL generated by CQL query barcode=={n}: "
+        "SELECT * FROM users WHERE barcode = '{n}'\n"
+        "{date} INFO  ProxyContext         {n}/users RES 200 {us}us mod-users-19.0.0 /users\n"),
+    'unified': (
+        "{date} INFO  PostgresClient       mod-inventory-storage CQL >>> SQL: id=={n} >>> "
+        "SELECT * FROM item WHERE id = '{n}'\n"
+        "{date} INFO  ProxyContext         {n}/item-storage RES 200 {us}us "
+        "mod-inventory-storage-19.0.0 /item-storage/items\n"),
+}
+
+#The timestamp of the first line, and the number of lines per second of the log
+START_DATE = datetime(2023, 6, 1, 12, 0, 0)
+LINES_PER_SECOND = 100
+
+def write_synthetic_log(log_handle, size_bytes, noise_ratio=0.9, formats=tuple(QUERY_FORMATS), seed=1):
+    """
+    Write a synthetic Okapi log of about size_bytes, the same for the same arguments.
+    noise_ratio: The fraction of the entries which are noise lines rather than query blocks
+    formats: The names of the QUERY_FORMATS of the query blocks
+    Returns the (bytes, lines, queries) written.
+    """
+    rng = random.Random(seed)
+    blocks = [QUERY_FORMATS[name] for name in formats]
+    written = lines = queries = 0
+    n = 0
+    second = None
+    while written < size_bytes:
+        if lines // LINES_PER_SECOND != second:
+            second = lines // LINES_PER_SECOND
+            date = (START_DATE + timedelta(seconds=second)).strftime('%Y-%m-%d %H:%M:%S') + ",000"
+        n += 1
+        if rng.random() < noise_ratio:
+            chunk = rng.choice(NOISE_LINES).format(date=date, n=n, us=rng.randint(100, 9999))
+        else:
+            chunk = rng.choice(blocks).format(date=date, n=n, us=rng.randint(100, 999999))
+            queries += 1
+        log_handle.write(chunk)
+        written += len(chunk)
+        lines += chunk.count("\n")
+    return (written, lines, queries)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic Okapi logfile')
+    parser.add_argument('--size-mb', type=int, default=100, help="Size of the synthetic log")
+    parser.add_argument('--noise-ratio', type=float, default=0.9,
+            help="The fraction of the entries which are noise lines rather than queries")
+    parser.add_argument('--formats', default=','.join(QUERY_FORMATS),
+            help=f"The comma separated formats of the queries, of: {', '.join(QUERY_FORMATS)}")
+    parser.add_argument('--seed', type=int, default=1, help="The seed of the random content")
+    parser.add_argument('log_file_path', metavar='logfile', help="The path to write the log to")
+    args = parser.parse_args()
+
+    formats = args.formats.split(',')
+    unknown = [name for name in formats if name not in QUERY_FORMATS]
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(unknown)}")
+    if not 0 <= args.noise_ratio < 1:
+        parser.error("--noise-ratio must be at least 0 and less than 1")
+    with open(args.log_file_path, 'w') as log_handle:
+        size, lines, queries = write_synthetic_log(log_handle, args.size_mb * 1024 * 1024,
+                args.noise_ratio, formats, args.seed)
+    print(f"Wrote {size / 1024 / 1024:.0f} MB, {lines} lines, {queries} queries")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#
+# usage: python3 benchmark-mapping.py [-n 20000] [-r 3] [-i instances.json]
+#
+# compares the single pass mapper of the built in mapping (map_instance) with the jmespath
+# mapper (map_record) which it replaced, checking that they give identical documents.
+# requires jmespath
+#
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import time
+import jmespath
+
+IDENTIFIER_TYPES = {
+    '8261054f-be78-422d-bd51-4ed9f33c3422' : 'ISBN',
+    '913300b2-03ed-469a-8179-c1092c991227' : 'ISSN',
+    'c858e4f2-2b6b-4385-842b-60732ee14abb' : 'LCCN',
+    '439bfbae-75bc-4f74-9fc7-b2a2d47ce3ef' : 'OCLC',
+    '7e591197-f335-4afb-bc6d-a6d76ca3bace' : 'System control number'
+}
+
+FORMAT_COUNT = 200
+
+# the jmespath mapping, for reference
+instance_id = jmespath.compile('id')
+instance_title = jmespath.compile('title')
+instance_short_title = jmespath.compile('indexTitle')
+instance_contributor = jmespath.compile('contributors[*].name')
+instance_subjects = jmespath.compile('subjects')
+instance_edition = jmespath.compile('editions')
+instance_series = jmespath.compile('series')
+instance_language = jmespath.compile('languages')
+instance_title_alt = jmespath.compile('alternativeTitles[*].alternativeTitle')
+instance_publisher = jmespath.compile('publication[*].publisher')
+instance_publishDate = jmespath.compile('publication[*].dateOfPublication')
+instance_physical = jmespath.compile('physicalDescriptions')
+instance_url = jmespath.compile('electronicAccess[*].uri')
+instance_isbn = jmespath.compile('identifiers[?identifierTypeId == `8261054f-be78-422d-bd51-4ed9f33c3422`].value')
+instance_issn = jmespath.compile('identifiers[?identifierTypeId == `913300b2-03ed-469a-8179-c1092c991227`].value')
+instance_lccn = jmespath.compile('identifiers[?identifierTypeId == `c858e4f2-2b6b-4385-842b-60732ee14abb`].value')
+instance_oclc = jmespath.compile('identifiers[?identifierTypeId == `439bfbae-75bc-4f74-9fc7-b2a2d47ce3ef`].value')
+instance_formats = jmespath.compile('instanceFormatIds | [0]')
+
+def main():
+    args = parse_command_line_args()
+    indexer = load_indexer()
+    if args.instances:
+        with open(args.instances) as instances_file:
+            instances = json.load(instances_file)
+        if isinstance(instances, dict):
+            instances = instances['instances']
+    else:
+        instances = list(gen_instances(args.count))
+    formats = dict((str(i), 'format {}'.format(i)) for i in range(FORMAT_COUNT))
+    references = {'identifierTypes' : IDENTIFIER_TYPES, 'instanceFormats' : formats}
+    field_mapping = indexer.resolve_mapping(indexer.DEFAULT_MAPPING, references)
+
+    def jmespath_mapper(instance):
+        return format_record(map_record(instance), formats)
+
+    def single_pass_mapper(instance):
+        return indexer.map_instance(instance, field_mapping, references)
+
+    for instance in instances:
+        expected = jmespath_mapper(instance)
+        actual = single_pass_mapper(instance)
+        if actual != expected:
+            raise SystemExit("Different documents for instance {}:\n{}\n{}".format(
+                instance.get('id'), expected, actual))
+    print("Identical documents for {} instances".format(len(instances)))
+
+    jmespath_rate = time_mapper(jmespath_mapper, instances, args.repeat)
+    single_pass_rate = time_mapper(single_pass_mapper, instances, args.repeat)
+    print("jmespath mapper: {:.0f} instances/s".format(jmespath_rate))
+    print("single pass mapper: {:.0f} instances/s ({:.1f}x)".format(single_pass_rate,
+                                                                   single_pass_rate / jmespath_rate))
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', help='number of synthetic instances, default 20000',
+                        type=int, default=20000)
+    parser.add_argument('-r', '--repeat', help='number of timed runs of each mapper, default 3',
+                        type=int, default=3)
+    parser.add_argument('-i', '--instances', help='JSON file of instances (such as a response of '
+                        '/instance-storage/instances) instead of synthetic instances')
+
+    args = parser.parse_args()
+
+    return args
+
+def load_indexer():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index-records.py')
+    spec = importlib.util.spec_from_file_location('index_records', path)
+    indexer = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(indexer)
+    return indexer
+
+def gen_instances(count, seed=1):
+    # instances with the shapes of inventory storage, including missing fields, empty lists,
+    # and identifiers and contributors without values
+    rng = random.Random(seed)
+    for i in range(count):
+        instance = {
+            'id': '{:08x}-0000-4000-8000-{:012x}'.format(i, rng.getrandbits(48)),
+            'title': 'Title {}'.format(i),
+            'indexTitle': 'title {}'.format(i),
+            'contributors': [{'name': 'Author {}'.format(j)} for j in range(rng.randint(0, 3))],
+            'subjects': ['Subject {}'.format(j) for j in range(rng.randint(0, 4))],
+            'editions': ['{}th ed.'.format(i % 9)],
+            'series': [],
+            'languages': rng.sample(['eng', 'ger', 'fre', 'spa'], rng.randint(0, 2)),
+            'alternativeTitles': [{'alternativeTitle': 'Alt {}'.format(i)}] if i % 4 == 0 else [],
+            'publication': [{'publisher': 'Publisher {}'.format(i), 'dateOfPublication': str(1900 + i % 120)}],
+            'physicalDescriptions': ['{} p.'.format(rng.randint(10, 900))],
+            'electronicAccess': [{'uri': 'https://example.org/{}'.format(i)}] if i % 5 == 0 else [],
+            'identifiers': [{'identifierTypeId': rng.choice(list(IDENTIFIER_TYPES)), 'value': str(rng.getrandbits(40))}
+                            for _ in range(rng.randint(0, 8))],
+            'instanceFormatIds': [str(rng.randrange(FORMAT_COUNT + 20))] if i % 3 else []
+        }
+        if i % 7 == 0:
+            del instance['editions']
+            instance['contributors'].append({'contributorTypeId': list(IDENTIFIER_TYPES)[0]})
+        if i % 11 == 0:
+            instance['identifiers'].append({'identifierTypeId': list(IDENTIFIER_TYPES)[1]})
+            instance['publication'] = None
+        yield instance
+
+def map_record(instance_record):
+    vufind_document = {}
+
+    vufind_document['id'] = instance_id.search(instance_record)
+    vufind_document['title'] = instance_title.search(instance_record)
+    vufind_document['title_short'] = instance_short_title.search(instance_record)
+    vufind_document['title_full'] = instance_title.search(instance_record)
+    vufind_document['author'] = instance_contributor.search(instance_record)
+    vufind_document['topic'] = instance_subjects.search(instance_record)
+    vufind_document['edition'] = instance_edition.search(instance_record)
+    vufind_document['series'] = instance_series.search(instance_record)
+    vufind_document['language'] =instance_language.search(instance_record)
+    vufind_document['title_alt'] = instance_title_alt.search(instance_record)
+    vufind_document['publisher'] = instance_publisher.search(instance_record)
+    vufind_document['publishDate'] = instance_publishDate.search(instance_record)
+    vufind_document['physical'] = instance_physical.search(instance_record)
+    vufind_document['url'] = instance_url.search(instance_record)
+    vufind_document['isbn'] = instance_isbn.search(instance_record)
+    vufind_document['issn'] = instance_issn.search(instance_record)
+    vufind_document['lccn'] = instance_lccn.search(instance_record)
+    vufind_document['oclc_num'] = instance_oclc.search(instance_record)
+    vufind_document['format'] = instance_formats.search(instance_record)
+
+    return vufind_document
+
+def format_record(document, formats):
+    if document['format'] is not None:
+        try:
+            document['format'] = formats[document['format']]
+        except KeyError:
+            document['format'] = None
+    return document
+
+def time_mapper(mapper, instances, repeat):
+    # the best rate of the runs, in instances per second
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for instance in instances:
+            mapper(instance)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(instances) / best
+
+if __name__ == "__main__":
+    main()
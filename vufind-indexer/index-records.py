@@ -5,38 +5,115 @@
 #
 
 import argparse
-import jmespath
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# map
-instance_id = jmespath.compile('id')
-instance_title = jmespath.compile('title')
-instance_short_title = jmespath.compile('indexTitle')
-instance_contributor = jmespath.compile('contributors[*].name')
-instance_subjects = jmespath.compile('subjects')
-instance_edition = jmespath.compile('editions')
-instance_series = jmespath.compile('series')
-instance_language = jmespath.compile('languages')
-instance_title_alt = jmespath.compile('alternativeTitles[*].alternativeTitle')
-instance_publisher = jmespath.compile('publication[*].publisher')
-instance_publishDate = jmespath.compile('publication[*].dateOfPublication')
-instance_physical = jmespath.compile('physicalDescriptions')
-instance_url = jmespath.compile('electronicAccess[*].uri')
-instance_isbn = jmespath.compile('identifiers[?identifierTypeId == `8261054f-be78-422d-bd51-4ed9f33c3422`].value')
-instance_issn = jmespath.compile('identifiers[?identifierTypeId == `913300b2-03ed-469a-8179-c1092c991227`].value')
-instance_lccn = jmespath.compile('identifiers[?identifierTypeId == `c858e4f2-2b6b-4385-842b-60732ee14abb`].value')
-instance_oclc = jmespath.compile('identifiers[?identifierTypeId == `439bfbae-75bc-4f74-9fc7-b2a2d47ce3ef`].value')
-instance_formats = jmespath.compile('instanceFormatIds | [0]')
+# instances updated up to this long before an incremental run started are indexed again,
+# in case of clock differences between this host and FOLIO
+CHECKPOINT_OVERLAP = timedelta(minutes=5)
+
+# number of ids per Okapi query when looking for deleted instances
+DELETE_CHECK_SIZE = 100
+
+# the reference data which mappings can refer to, by name: each is paged from the Okapi path,
+# as a dict of the id to the name of each record, or is a static dict of "values"
+REFERENCE_TABLES = {
+    'instanceFormats' : {'path' : '/instance-formats', 'records' : 'instanceFormats'},
+    'identifierTypes' : {'path' : '/identifier-types', 'records' : 'identifierTypes'},
+    'contributorTypes' : {'path' : '/contributor-types', 'records' : 'contributorTypes'}
+}
+
+# the mapping of instances to VuFind documents, which can be replaced with a JSON mapping file
+# (see --write-mapping). Each field has a rule applied to the "from" field of the instance:
+#   value: the value of the field
+#   list: the "key" of each object of the list
+#   first: the first item of the list
+#   identifier: the values of the identifiers of the identifier "type" (a name or id)
+# and optionally a "reference" table giving the names of the ids
+DEFAULT_MAPPING = {
+    'references' : {},
+    'fields' : [
+        {'field' : 'id', 'rule' : 'value', 'from' : 'id'},
+        {'field' : 'title', 'rule' : 'value', 'from' : 'title'},
+        {'field' : 'title_short', 'rule' : 'value', 'from' : 'indexTitle'},
+        {'field' : 'title_full', 'rule' : 'value', 'from' : 'title'},
+        {'field' : 'author', 'rule' : 'list', 'from' : 'contributors', 'key' : 'name'},
+        {'field' : 'topic', 'rule' : 'value', 'from' : 'subjects'},
+        {'field' : 'edition', 'rule' : 'value', 'from' : 'editions'},
+        {'field' : 'series', 'rule' : 'value', 'from' : 'series'},
+        {'field' : 'language', 'rule' : 'value', 'from' : 'languages'},
+        {'field' : 'title_alt', 'rule' : 'list', 'from' : 'alternativeTitles', 'key' : 'alternativeTitle'},
+        {'field' : 'publisher', 'rule' : 'list', 'from' : 'publication', 'key' : 'publisher'},
+        {'field' : 'publishDate', 'rule' : 'list', 'from' : 'publication', 'key' : 'dateOfPublication'},
+        {'field' : 'physical', 'rule' : 'value', 'from' : 'physicalDescriptions'},
+        {'field' : 'url', 'rule' : 'list', 'from' : 'electronicAccess', 'key' : 'uri'},
+        {'field' : 'isbn', 'rule' : 'identifier', 'from' : 'identifiers', 'type' : 'ISBN'},
+        {'field' : 'issn', 'rule' : 'identifier', 'from' : 'identifiers', 'type' : 'ISSN'},
+        {'field' : 'lccn', 'rule' : 'identifier', 'from' : 'identifiers', 'type' : 'LCCN'},
+        {'field' : 'oclc_num', 'rule' : 'identifier', 'from' : 'identifiers', 'type' : 'OCLC'},
+        {'field' : 'format', 'rule' : 'first', 'from' : 'instanceFormatIds', 'reference' : 'instanceFormats'}
+    ]
+}
+
+# reference data is fetched again after this many seconds, default one day
+REFERENCE_CACHE_TTL = 24 * 60 * 60
 
 def main():
     args = parse_command_line_args()
-    token = get_token(args.okapi_url, args.user_name, args.password, args.tenant)
-    formats = get_instance_formats(token, args.okapi_url, args.tenant)
-    for instance in gen_instance_storage_records(token, args.okapi_url, args.tenant):
-        vufind_doc = map_record(instance)
-        format_record(vufind_doc, formats)
-        print("Indexing instance: " + vufind_doc['id'])
-        print(index_record(vufind_doc, args.solr_url))
+    if args.write_mapping:
+        with open(args.write_mapping, 'w') as mapping_file:
+            json.dump(DEFAULT_MAPPING, mapping_file, indent=2)
+        return
+    session = get_session(args.pool_size, args.retries, args.backoff)
+    token = get_token(session, args.okapi_url, args.user_name, args.password, args.tenant)
+    mapping = load_mapping(args.mapping)
+    references = get_references(session, token, args.okapi_url, args.tenant, mapping,
+                                args.reference_cache, args.reference_ttl)
+    field_mapping = resolve_mapping(mapping, references)
+
+    def mapper(instance):
+        return map_instance(instance, field_mapping, references)
+
+    # the ids of the documents rejected by Solr
+    rejected = []
+    if args.incremental:
+        checkpoint = index_incremental(session, args, token, mapper, rejected)
+    elif args.pipeline:
+        index_pipelined(args, token, mapper, rejected)
+    elif args.partitions > 1:
+        index_partitioned(args, token, mapper, rejected)
+    else:
+        batch = []
+        for instance in gen_instance_storage_records(session, token, args.okapi_url, args.tenant,
+                                                     args.page_size):
+            vufind_doc = mapper(instance)
+            batch.append(vufind_doc)
+            if len(batch) >= args.batch_size:
+                print("Indexing {} instances to: {}".format(len(batch), vufind_doc['id']))
+                print(index_records(session, batch, args.solr_url, args.commit_within, rejected))
+                batch = []
+        if batch:
+            print("Indexing {} instances to: {}".format(len(batch), batch[-1]['id']))
+            print(index_records(session, batch, args.solr_url, args.commit_within, rejected))
+    print("Committing" + (" and optimizing" if args.optimize else ""))
+    print(commit_index(session, args.solr_url, args.optimize))
+    if rejected:
+        if args.incremental:
+            # the next run indexes the same instances again, from the start
+            checkpoint.pop('last_id', None)
+            save_checkpoint(args.checkpoint, checkpoint)
+        raise SystemExit("Solr rejected {} instances: {}".format(len(rejected), ' '.join(rejected)))
+    if args.incremental:
+        # the next run indexes the instances updated since this run started
+        save_checkpoint(args.checkpoint, {'completed': checkpoint['started']})
 
 def parse_command_line_args():
     parser = argparse.ArgumentParser()
@@ -48,117 +125,583 @@ def parse_command_line_args():
                         default='http://localhost:9130')
     parser.add_argument('-s', '--solr-url', help='address of solr core',
                         default='http://localhost:8080/solr/biblio')
+    parser.add_argument('-l', '--page-size', help='number of instances per page from Okapi, default 1000',
+                        type=int, default=1000)
+    parser.add_argument('-b', '--batch-size', help='number of documents per Solr update, default 500',
+                        type=int, default=500)
+    parser.add_argument('-w', '--commit-within', help='milliseconds within which Solr commits each update, '
+                        'making documents visible during the run (default: only commit at the end)',
+                        type=int, default=None)
+    parser.add_argument('--optimize', help='optimize the index after the final commit',
+                        action='store_true')
+    parser.add_argument('--pipeline', help='fetch, map and index concurrently',
+                        action='store_true')
+    parser.add_argument('--map-workers', help='number of mapping threads of the pipeline, default 1',
+                        type=int, default=1)
+    parser.add_argument('--index-workers', help='number of Solr update threads of the pipeline, default 2',
+                        type=int, default=2)
+    parser.add_argument('--queue-size', help='number of batches waiting between the stages of the pipeline, '
+                        'default 4', type=int, default=4)
+    parser.add_argument('-n', '--partitions', help='number of id ranges harvested and indexed in parallel, '
+                        'default 1', type=int, default=1)
+    parser.add_argument('--progress-interval', help='seconds between progress reports of the partitions, '
+                        'default 10', type=float, default=10)
+    parser.add_argument('-i', '--incremental', help='index only the instances updated since the last '
+                        'successful run', action='store_true')
+    parser.add_argument('-c', '--checkpoint', help='checkpoint file of the incremental runs, '
+                        'default index-checkpoint.json', default='index-checkpoint.json')
+    parser.add_argument('--check-deletes', help='also delete the documents of deleted instances from Solr '
+                        'in an incremental run, checking every document of the core', action='store_true')
+    parser.add_argument('-m', '--mapping', help='JSON mapping file of instances to VuFind documents '
+                        '(default: the built in mapping)')
+    parser.add_argument('--write-mapping', help='write the built in mapping to this file, as a starting point, '
+                        'and exit')
+    parser.add_argument('--reference-cache', help='JSON file caching the reference data between runs')
+    parser.add_argument('--reference-ttl', help='seconds for which the cached reference data is used, '
+                        'default 86400', type=int, default=REFERENCE_CACHE_TTL)
+    parser.add_argument('--pool-size', help='number of keep-alive connections per host, default 10',
+                        type=int, default=10)
+    parser.add_argument('--retries', help='number of retries of connection errors and 5xx responses, default 5',
+                        type=int, default=5)
+    parser.add_argument('--backoff', help='backoff factor in seconds between retries, default 0.5',
+                        type=float, default=0.5)
 
     args = parser.parse_args()
+    if args.pipeline and args.partitions > 1:
+        parser.error('--pipeline and --partitions cannot be combined')
+    if args.incremental and (args.pipeline or args.partitions > 1):
+        parser.error('--incremental cannot be combined with --pipeline or --partitions')
+    if args.check_deletes and not args.incremental:
+        parser.error('--check-deletes requires --incremental')
 
     return args
 
-def map_record(instance_record):
+def index_pipelined(args, token, mapper, rejected):
+    # fetch pages of instances, map them and post them to Solr in concurrent stages,
+    # connected by bounded queues, so a stage waits when the next one falls behind
+    instance_batches = queue.Queue(args.queue_size)
+    document_batches = queue.Queue(args.queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def fetch():
+        session = get_session(args.pool_size, args.retries, args.backoff)
+        batch = []
+        for instance in gen_instance_storage_records(session, token, args.okapi_url, args.tenant,
+                                                     args.page_size):
+            if stop.is_set():
+                return
+            batch.append(instance)
+            if len(batch) >= args.batch_size:
+                if not put_batch(instance_batches, batch, stop):
+                    return
+                batch = []
+        if batch:
+            put_batch(instance_batches, batch, stop)
+
+    def map_batches():
+        for batch in iter_batches(instance_batches, stop):
+            documents = [mapper(instance) for instance in batch]
+            if not put_batch(document_batches, documents, stop):
+                return
+
+    def index_batches():
+        session = get_session(args.pool_size, args.retries, args.backoff)
+        for batch in iter_batches(document_batches, stop):
+            status = index_records(session, batch, args.solr_url, args.commit_within, rejected)
+            print("Indexing {} instances to: {}\n{}".format(len(batch), batch[-1]['id'], status))
+
+    def run_stage(stage, workers, next_queue, next_workers):
+        threads = [threading.Thread(target=run_worker, args=(stage,)) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if next_queue is not None:
+            for _ in range(next_workers):
+                put_batch(next_queue, None, stop)
+
+    def run_worker(stage):
+        try:
+            stage()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    stages = [
+        threading.Thread(target=run_stage, args=(fetch, 1, instance_batches, args.map_workers)),
+        threading.Thread(target=run_stage, args=(map_batches, args.map_workers, document_batches,
+                                                 args.index_workers)),
+        threading.Thread(target=run_stage, args=(index_batches, args.index_workers, None, 0))
+    ]
+    for stage in stages:
+        stage.start()
+    try:
+        for stage in stages:
+            stage.join()
+    finally:
+        # when interrupted, the stages stop at their next instance or batch
+        stop.set()
+    if errors:
+        raise errors[0]
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def save_checkpoint(path, checkpoint):
+    # replace the file in one step, so a crash never leaves a partial checkpoint
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+def index_incremental(session, args, token, mapper, rejected):
+    # index the instances updated since the last completed run (all instances on the first run),
+    # saving the last id indexed after each batch, so an interrupted run resumes from there
+    checkpoint = load_checkpoint(args.checkpoint)
+    if 'started' in checkpoint:
+        print("Resuming the run started {} from: {}".format(checkpoint['started'], checkpoint.get('last_id')))
+    else:
+        started = datetime.now(timezone.utc) - CHECKPOINT_OVERLAP
+        checkpoint['started'] = started.isoformat(timespec='milliseconds')
+        save_checkpoint(args.checkpoint, checkpoint)
+    query = None
+    if 'completed' in checkpoint:
+        print("Indexing the instances updated since: " + checkpoint['completed'])
+        query = 'metadata.updatedDate>="{}"'.format(checkpoint['completed'])
+    batch = []
+    for instance in gen_instance_storage_records(session, token, args.okapi_url, args.tenant,
+                                                 args.page_size, checkpoint.get('last_id'), query=query):
+        batch.append(mapper(instance))
+        if len(batch) >= args.batch_size:
+            index_checkpoint_batch(session, args, checkpoint, batch, rejected)
+            batch = []
+    if batch:
+        index_checkpoint_batch(session, args, checkpoint, batch, rejected)
+    if args.check_deletes:
+        delete_missing_instances(session, token, args.okapi_url, args.tenant, args.solr_url)
+    return checkpoint
+
+def index_checkpoint_batch(session, args, checkpoint, batch, rejected):
+    print("Indexing {} instances to: {}".format(len(batch), batch[-1]['id']))
+    print(index_records(session, batch, args.solr_url, args.commit_within, rejected))
+    checkpoint['last_id'] = batch[-1]['id']
+    save_checkpoint(args.checkpoint, checkpoint)
+
+def delete_missing_instances(session, token, okapi, tenant, solr_url):
+    # delete the documents of Solr whose instances no longer exist in FOLIO, skipping the documents
+    # whose ids are not UUIDs, which are not FOLIO instances
+    headers = {
+        "X-Okapi-Tenant" : tenant,
+        "X-Okapi-Token" : token,
+        "Accept" : "application/json"
+    }
+    for ids in gen_solr_ids(session, solr_url):
+        ids = [id for id in ids if is_uuid(id)]
+        deleted = []
+        for i in range(0, len(ids), DELETE_CHECK_SIZE):
+            check_ids = ids[i:i + DELETE_CHECK_SIZE]
+            params = {
+                "query" : 'id==({})'.format(' or '.join('"{}"'.format(id) for id in check_ids)),
+                "limit" : len(check_ids),
+                "totalRecords" : "none"
+            }
+            r = session.get(okapi + '/instance-storage/instances',
+                            headers=headers,
+                            params=params)
+            r.raise_for_status()
+            found = set(instance['id'] for instance in r.json()['instances'])
+            deleted.extend(id for id in check_ids if id not in found)
+        if deleted:
+            print("Deleting {} instances: {}".format(len(deleted), ' '.join(deleted)))
+            print(delete_records(session, deleted, solr_url))
+
+def is_uuid(value):
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+def gen_solr_ids(session, solr_url, rows=1000):
+    # page through the ids of the Solr documents with a cursor
+    params = {
+        'q' : '*:*',
+        'fl' : 'id',
+        'sort' : 'id asc',
+        'rows' : rows,
+        'wt' : 'json',
+        'cursorMark' : '*'
+    }
+    while True:
+        r = session.get(solr_url + '/select', params=params)
+        r.raise_for_status()
+        response = r.json()
+        ids = [document['id'] for document in response['response']['docs']]
+        if ids:
+            yield ids
+        if response['nextCursorMark'] == params['cursorMark']:
+            return
+        params['cursorMark'] = response['nextCursorMark']
+
+def get_partitions(count):
+    # split the UUID space into count ranges of ids, as (start_id, end_id),
+    # where None is the start or end of the whole range
+    bounds = [str(uuid.UUID(int=(i << 128) // count)) for i in range(1, count)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+def index_partitioned(args, token, mapper, rejected):
+    # harvest and index each range of ids in its own thread, with its own session,
+    # keyset paging and Solr batches, reporting the progress of the partitions
+    partitions = get_partitions(args.partitions)
+    counts = [0] * len(partitions)
+    elapsed = [0.0] * len(partitions)
+    stop = threading.Event()
+    errors = []
+
+    def index_partition(number, start_id, end_id):
+        session = get_session(args.pool_size, args.retries, args.backoff)
+        started = time.time()
+        batch = []
+        try:
+            for instance in gen_instance_storage_records(session, token, args.okapi_url, args.tenant,
+                                                         args.page_size, start_id, end_id):
+                # another partition failed: the run is not committed, so drop the batch
+                if stop.is_set():
+                    return
+                batch.append(mapper(instance))
+                if len(batch) >= args.batch_size:
+                    index_partition_batch(session, number, batch)
+                    batch = []
+            if batch and not stop.is_set():
+                index_partition_batch(session, number, batch)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            elapsed[number] = time.time() - started
+
+    def index_partition_batch(session, number, batch):
+        status = index_records(session, batch, args.solr_url, args.commit_within, rejected)
+        counts[number] += len(batch)
+        print("Partition {}: indexing {} instances to: {}\n{}".format(number + 1, len(batch),
+                                                                      batch[-1]['id'], status))
+
+    started = time.time()
+    threads = [threading.Thread(target=index_partition, args=(number, start_id, end_id))
+               for number, (start_id, end_id) in enumerate(partitions)]
+    for thread in threads:
+        thread.start()
+    next_report = started + args.progress_interval
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(max(next_report - time.time(), 0))
+                if time.time() >= next_report:
+                    seconds = time.time() - started
+                    print("Progress: {} instances in {:.0f}s, {:.0f}/s, by partition: {}".format(
+                        sum(counts), seconds, sum(counts) / seconds, ' '.join(str(count) for count in counts)))
+                    next_report += args.progress_interval
+    except BaseException:
+        # interrupted: the partitions stop at their next instance
+        stop.set()
+        raise
+    for number, (start_id, end_id) in enumerate(partitions):
+        print("Partition {} ({} to {}): {} instances in {:.1f}s, {:.0f}/s".format(
+            number + 1, start_id or 'start', end_id or 'end', counts[number], elapsed[number],
+            counts[number] / elapsed[number] if elapsed[number] else 0))
+    if errors:
+        raise errors[0]
+
+def put_batch(batch_queue, batch, stop):
+    # wait for room in the queue, unless the pipeline is stopping: whether the batch was queued
+    while not stop.is_set():
+        try:
+            batch_queue.put(batch, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def iter_batches(batch_queue, stop):
+    # the batches of the queue, until None or the pipeline is stopping
+    while not stop.is_set():
+        try:
+            batch = batch_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if batch is None:
+            return
+        yield batch
+
+def get_session(pool_size=10, retries=5, backoff=0.5):
+    # keep-alive connections to Okapi and Solr, retrying connection errors and 5xx responses
+    # with exponential backoff (backoff, 2 * backoff, 4 * backoff, ... seconds)
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=frozenset(['GET', 'POST']))
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def map_instance(instance_record, field_mapping, references=None):
+    # the document of the field mapping (see resolve_mapping), walking the instance once: each field
+    # is read once per mapping, the identifiers are grouped by type in a single loop, and the
+    # reference data is looked up in the dicts of references
     vufind_document = {}
+    identifiers_by_type = {}
 
-    vufind_document['id'] = instance_id.search(instance_record)
-    vufind_document['title'] = instance_title.search(instance_record)
-    vufind_document['title_short'] = instance_short_title.search(instance_record)
-    vufind_document['title_full'] = instance_title.search(instance_record)
-    vufind_document['author'] = instance_contributor.search(instance_record)
-    vufind_document['topic'] = instance_subjects.search(instance_record)
-    vufind_document['edition'] = instance_edition.search(instance_record)
-    vufind_document['series'] = instance_series.search(instance_record)
-    vufind_document['language'] =instance_language.search(instance_record)
-    vufind_document['title_alt'] = instance_title_alt.search(instance_record)
-    vufind_document['publisher'] = instance_publisher.search(instance_record)
-    vufind_document['publishDate'] = instance_publishDate.search(instance_record)
-    vufind_document['physical'] = instance_physical.search(instance_record)
-    vufind_document['url'] = instance_url.search(instance_record)
-    vufind_document['isbn'] = instance_isbn.search(instance_record)
-    vufind_document['issn'] = instance_issn.search(instance_record)
-    vufind_document['lccn'] = instance_lccn.search(instance_record)
-    vufind_document['oclc_num'] = instance_oclc.search(instance_record)
-    vufind_document['format'] = instance_formats.search(instance_record)
+    for vufind_field, rule, field, key, reference in field_mapping:
+        value = instance_record.get(field)
+        if rule == 'list':
+            if isinstance(value, list):
+                value = [item[key] for item in value
+                         if isinstance(item, dict) and item.get(key) is not None]
+            else:
+                value = None
+        elif rule == 'first':
+            if isinstance(value, list):
+                value = value[0] if value else None
+            else:
+                value = None
+        elif rule == 'identifier':
+            if isinstance(value, list):
+                if field not in identifiers_by_type:
+                    identifiers_by_type[field] = get_identifiers_by_type(value)
+                value = identifiers_by_type[field].get(key, [])
+            else:
+                value = None
+        if reference is not None and value is not None:
+            table = references[reference]
+            if isinstance(value, list):
+                value = [table[item] for item in value if item in table]
+            else:
+                value = table.get(value)
+        vufind_document[vufind_field] = value
 
     return vufind_document
 
-def format_record(document, formats):
-    if document['format'] is not None:
-        try:
-            document['format'] = formats[document['format']]
-        except KeyError:
-            document['format'] = None
-    return document
+def load_mapping(path=None):
+    if path is None:
+        return DEFAULT_MAPPING
+    with open(path) as mapping_file:
+        mapping = json.load(mapping_file)
+    for field in mapping['fields']:
+        if field.get('rule', 'value') not in ('value', 'list', 'first', 'identifier'):
+            raise ValueError("Unknown rule of field {}: {}".format(field['field'], field['rule']))
+    return mapping
+
+def get_reference_tables(mapping):
+    # the reference tables of the mapping, by name
+    tables = dict(REFERENCE_TABLES)
+    tables.update(mapping.get('references', {}))
+    return tables
+
+def get_needed_references(mapping):
+    # the names of the reference tables used by the mapping
+    needed = set()
+    for field in mapping['fields']:
+        if field.get('reference'):
+            needed.add(field['reference'])
+        if field.get('rule') == 'identifier':
+            needed.add('identifierTypes')
+    return needed
+
+def resolve_mapping(mapping, references):
+    # the (VuFind field, rule, instance field, key, reference table) of each field of the mapping,
+    # with the identifier types resolved to their ids
+    identifier_types = references.get('identifierTypes', {})
+    identifier_type_ids = dict((name, id) for id, name in identifier_types.items())
+    field_mapping = []
+    for field in mapping['fields']:
+        rule = field.get('rule', 'value')
+        key = field.get('key')
+        if rule == 'identifier':
+            key = field['type'] if field['type'] in identifier_types else identifier_type_ids.get(field['type'])
+            if key is None:
+                raise ValueError("Unknown identifier type of field {}: {}".format(field['field'], field['type']))
+        reference = field.get('reference')
+        if reference is not None and reference not in references:
+            raise ValueError("Unknown reference of field {}: {}".format(field['field'], reference))
+        field_mapping.append((field['field'], rule, field['from'], key, reference))
+    return field_mapping
 
-def index_record(document, solr_url):
+def get_references(session, token, okapi, tenant, mapping, cache_path=None, ttl=REFERENCE_CACHE_TTL):
+    # the reference tables used by the mapping, as dicts of id to name, read once per run,
+    # or from the cache file when it is for the same Okapi and tenant and younger than ttl seconds
+    tables = get_reference_tables(mapping)
+    needed = get_needed_references(mapping)
+    unknown = needed - set(tables)
+    if unknown:
+        raise ValueError("Unknown reference tables: {}".format(', '.join(sorted(unknown))))
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+        if (cache.get('okapi') != okapi or cache.get('tenant') != tenant
+                or time.time() - cache.get('fetched', 0) > ttl):
+            cache = {}
+    cached = cache.get('references', {})
+    references = {}
+    for name in sorted(needed):
+        if 'values' in tables[name]:
+            references[name] = tables[name]['values']
+        elif name in cached:
+            references[name] = cached[name]
+        else:
+            print("Reading reference data: " + name)
+            references[name] = get_reference_table(session, token, okapi, tenant,
+                                                   tables[name]['path'], tables[name]['records'],
+                                                   tables[name].get('name', 'name'))
+            cached[name] = references[name]
+    if cache_path and cached != cache.get('references'):
+        save_checkpoint(cache_path, {
+            'okapi' : okapi,
+            'tenant' : tenant,
+            'fetched' : cache.get('fetched', time.time()),
+            'references' : cached
+        })
+    return references
+
+def get_identifiers_by_type(identifiers):
+    identifiers_by_type = {}
+    for identifier in identifiers:
+        if isinstance(identifier, dict) and identifier.get('value') is not None:
+            identifiers_by_type.setdefault(identifier.get('identifierTypeId'), []).append(identifier['value'])
+    return identifiers_by_type
+
+def index_records(session, documents, solr_url, commit_within=None, rejected=None):
+    # the ids of the documents rejected by Solr are added to rejected
     params = {
-        'commit'  : 'true',
         'json.command' : 'false'
     }
-    r = requests.post(solr_url + '/update',
-                      params=params,
-                      json=document)
-    
+    if commit_within is not None:
+        params['commitWithin'] = commit_within
+    r = session.post(solr_url + '/update',
+                     params=params,
+                     json=documents)
+    if r.status_code != 400:
+        r.raise_for_status()
+        return r.status_code
+
+    # Solr rejects the whole request for one bad document: post the documents one at a time,
+    # so only the bad ones are left out, and report them
+    batch_rejected = []
+    status = r.status_code
+    for document in documents:
+        if len(documents) > 1:
+            r = session.post(solr_url + '/update',
+                             params=params,
+                             json=[document])
+        if r.status_code == 400:
+            print("Solr rejected instance {}: {}".format(document.get('id'), r.text))
+            batch_rejected.append(document.get('id'))
+        else:
+            r.raise_for_status()
+            status = r.status_code
+    if len(documents) > 1 and len(batch_rejected) == len(documents):
+        # not a bad document, but a bad request, such as an unknown field of the mapping
+        raise RuntimeError("Solr rejected all {} documents of the batch: {}".format(len(documents), r.text))
+    if rejected is not None:
+        rejected.extend(batch_rejected)
+
+    return status
+
+def delete_records(session, ids, solr_url):
+    r = session.post(solr_url + '/update',
+                     json={'delete': ids})
+    r.raise_for_status()
+
+    return r.status_code
+
+def commit_index(session, solr_url, optimize=False):
+    params = {
+        'commit' : 'true'
+    }
+    if optimize:
+        params['optimize'] = 'true'
+    r = session.post(solr_url + '/update',
+                     params=params,
+                     json={})
+    r.raise_for_status()
+
     return r.status_code
 
-def gen_instance_storage_records(token, okapi, tenant):
-    count = 0
-    limit = 50
-    page_count = 0
+def gen_instance_storage_records(session, token, okapi, tenant, limit=1000, start_id=None, end_id=None,
+                                 query=None):
+    # page through the instances in id order, each page starting after the last id of the
+    # previous page (keyset paging), so that deep pages are as fast as the first page;
+    # start_id (inclusive) and end_id (exclusive) limit the instances to a range of ids,
+    # and query (CQL) limits them further
     headers = {
         "X-Okapi-Tenant" : tenant,
         "X-Okapi-Token" : token,
         "Accept" : "application/json"
     }
-    params = {
-        "offset" : 0,
-        "limit" : limit
-    }
-    r = requests.get(okapi + '/instance-storage/instances',
-                     headers=headers,
-                     params=params)
-    total_records = r.json()['totalRecords']
-    while count < total_records:
-        instances_response = r
-        instances_json = r.json()
-        page_size = len(instances_json['instances'])
-        instance_index = page_count
-        page_count += 1
-        count += 1
-
-        if page_count == page_size and params['offset'] + limit < total_records:
-            page_count = 0
-            params['offset'] += limit
-            r = requests.get(okapi + '/instance-storage/instances',
-                             headers=headers,
-                             params=params)
-        yield instances_json['instances'][instance_index]
-
-def get_instance_formats(token, okapi, tenant):
+    last_id = None
+    while True:
+        clauses = ['({})'.format(query)] if query else []
+        if last_id is not None:
+            clauses.append('id>"{}"'.format(last_id))
+        elif start_id is not None:
+            clauses.append('id>="{}"'.format(start_id))
+        if end_id is not None:
+            clauses.append('id<"{}"'.format(end_id))
+        params = {
+            "query" : ' and '.join(clauses or ['cql.allRecords=1']) + ' sortBy id',
+            "limit" : limit,
+            "totalRecords" : "none"
+        }
+        r = session.get(okapi + '/instance-storage/instances',
+                        headers=headers,
+                        params=params)
+        r.raise_for_status()
+        instances = r.json()['instances']
+        yield from instances
+        if len(instances) < limit:
+            return
+        last_id = instances[-1]['id']
+
+def get_reference_table(session, token, okapi, tenant, path, records, name='name', limit=1000):
+    # page through all the records of the reference data, as a dict of id to name
     headers = {
         "X-Okapi-Tenant" : tenant,
         "X-Okapi-Token" : token,
         "Accept" : "application/json"
     }
     params = {
+        "query" : "cql.allRecords=1 sortBy id",
         "offset" : 0,
-        "limit" : 100
+        "limit" : limit
     }
-    r = requests.get(okapi + '/instance-formats',
-                     headers=headers,
-                     params=params)
-    list = r.json()['instanceFormats']
-    instance_formats = {}
-    for i in range(len(list)):
-        name = list[i]['name']
-        id = list[i]['id']
-        instance_formats[id] = name
-    return instance_formats
-  
-def get_token(okapi, username, password, tenant):
+    table = {}
+    while True:
+        r = session.get(okapi + path,
+                        headers=headers,
+                        params=params)
+        r.raise_for_status()
+        page = r.json()[records]
+        for record in page:
+            table[record['id']] = record[name]
+        if len(page) < limit:
+            return table
+        params['offset'] += limit
+
+def get_token(session, okapi, username, password, tenant):
     headers = {"X-Okapi-Tenant": tenant}
     payload = {
         "username" : username,
         "password" : password
     }
-    r = requests.post(okapi + '/authn/login', 
-                      headers=headers, json=payload)
+    r = session.post(okapi + '/authn/login',
+                     headers=headers, json=payload)
     return r.headers['x-okapi-token']
 
 if __name__ == "__main__":